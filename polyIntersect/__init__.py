@@ -1,11 +1,21 @@
 import os
 import logging
+import multiprocessing
+import threading
+
+import click
 
 
 from flask import Flask
 
 from polyIntersect.config import SETTINGS
+from polyIntersect.micro_functions.poly_intersect import refresh_layers
+from polyIntersect.micro_functions.poly_intersect import sync_mirror
 from polyIntersect.routes.api.v1 import endpoints, error
+from polyIntersect.routes.api.v1.polyIntersect_router import load_datasets
+from polyIntersect.routes.api.v1.polyIntersect_router import mirror_path
+from polyIntersect.routes.api.v1.polyIntersect_router import resolve_layer
+from polyIntersect.routes.api.v1.polyIntersect_router import warm_layers
 from polyIntersect.utils.files import load_config_json
 
 import CTRegisterMicroserviceFlask
@@ -22,22 +32,77 @@ app = Flask(__name__)
 # Routing
 app.register_blueprint(endpoints, url_prefix='/api/v1/polyIntersect')
 
-# CT
-info = load_config_json('register')
-swagger = load_config_json('swagger')
-
-CTRegisterMicroserviceFlask.register(
-    app=app,
-    name='poly_intersect',
-    info=info,
-    swagger=swagger,
-    mode=CTRegisterMicroserviceFlask.AUTOREGISTER_MODE if
-         os.getenv('CT_REGISTER_MODE') and
-         os.getenv('CT_REGISTER_MODE') == 'auto' else
-         CTRegisterMicroserviceFlask.NORMAL_MODE,
-    ct_url=os.getenv('CT_URL'),
-    url=os.getenv('LOCAL_URL')
-)
+# Look up every dataset's layer in the background while starting up, except
+# in the spawned pool processes, which import this package too
+if SETTINGS['gfw']['warm_up'] and multiprocessing.parent_process() is None:
+    warm_up = threading.Thread(target=warm_layers, args=(load_datasets(),))
+    warm_up.daemon = True
+    warm_up.start()
+
+# CT, only from the serving process: a spawned pool process registering
+# too would start its own registration timer, and exits if that fails
+if multiprocessing.parent_process() is None:
+    info = load_config_json('register')
+    swagger = load_config_json('swagger')
+
+    CTRegisterMicroserviceFlask.register(
+        app=app,
+        name='poly_intersect',
+        info=info,
+        swagger=swagger,
+        mode=CTRegisterMicroserviceFlask.AUTOREGISTER_MODE if
+             os.getenv('CT_REGISTER_MODE') and
+             os.getenv('CT_REGISTER_MODE') == 'auto' else
+             CTRegisterMicroserviceFlask.NORMAL_MODE,
+        ct_url=os.getenv('CT_URL'),
+        url=os.getenv('LOCAL_URL')
+    )
+
+
+@app.cli.command('refresh-layers')
+@click.pass_context
+def refresh_layers_command(ctx):
+    """Poll cached reference layers for upstream edits now."""
+    failed = False
+    for endpoint, changed in refresh_layers().items():
+        if isinstance(changed, Exception):
+            click.echo('{}: failed, {}'.format(endpoint, changed), err=True)
+            failed = True
+        else:
+            click.echo('{}: {}'.format(endpoint, 'changed' if changed else
+                                       'unchanged'))
+    if failed:
+        ctx.exit(1)
+
+
+@app.cli.command('sync-mirrors')
+@click.argument('datasets', nargs=-1)
+@click.pass_context
+def sync_mirrors_command(ctx, datasets):
+    """Download mirrored datasets, or all of them, from their source."""
+    config = load_datasets()
+    for dataset in datasets:
+        if dataset not in config:
+            raise click.UsageError('{} is not a dataset'.format(dataset))
+        if mirror_path(config[dataset]) is None:
+            raise click.UsageError('{} has no mirror'.format(dataset))
+
+    failed = False
+    for dataset in datasets or sorted(config):
+        mirror = mirror_path(config[dataset])
+        if mirror is None:
+            continue
+        # one failed layer does not stop the others from syncing
+        try:
+            provider, layer_url = resolve_layer(config[dataset]['id'])
+            count = sync_mirror(provider, layer_url, mirror)
+        except Exception as e:
+            click.echo('{}: failed, {}'.format(dataset, e), err=True)
+            failed = True
+            continue
+        click.echo('{}: {} features to {}'.format(dataset, count, mirror))
+    if failed:
+        ctx.exit(1)
 
 
 @app.errorhandler(403)
@@ -9,5 +9,42 @@ SETTINGS = {
     },
     'service': {
         'port': os.getenv('PORT')
+    },
+    'dissolve': {
+        'workers': int(os.getenv('DISSOLVE_WORKERS', '2')),
+        'partition_size': int(os.getenv('DISSOLVE_PARTITION_SIZE', '500'))
+    },
+    'overlay': {
+        'max_vertices': int(os.getenv('OVERLAY_MAX_VERTICES', '0'))
+    },
+    'esri': {
+        'workers': int(os.getenv('ESRI_WORKERS', '4'))
+    },
+    'http': {
+        'pool_connections': int(os.getenv('HTTP_POOL_CONNECTIONS', '10')),
+        'pool_maxsize': int(os.getenv('HTTP_POOL_MAXSIZE', '10')),
+        'max_retries': int(os.getenv('HTTP_MAX_RETRIES', '2')),
+        'connect_timeout': float(os.getenv('HTTP_CONNECT_TIMEOUT', '10')),
+        'read_timeout': float(os.getenv('HTTP_READ_TIMEOUT', '120'))
+    },
+    'tile_cache': {
+        # sqlite file shared by the workers on a host, off unless set
+        'path': os.getenv('TILE_CACHE_PATH', ''),
+        'max_bytes': int(os.getenv('TILE_CACHE_MAX_BYTES', str(1 << 30))),
+        'zoom': int(os.getenv('TILE_CACHE_ZOOM', '8')),
+        # seconds between polls of a layer's metadata for edits
+        'check_interval': float(os.getenv('TILE_CACHE_CHECK_INTERVAL', '300'))
+    },
+    'gfw': {
+        # seconds a dataset's layer url is used before it is looked up
+        # again, and for how much longer a stale one is served meanwhile
+        'ttl': float(os.getenv('GFW_DATASET_TTL', '3600')),
+        'max_stale': float(os.getenv('GFW_DATASET_MAX_STALE', '86400')),
+        'warm_up': os.getenv('GFW_WARM_UP') == 'True',
+        'workers': int(os.getenv('GFW_WORKERS', '4'))
+    },
+    'mirror': {
+        # directory holding the GeoPackage mirrors named in datasets.json
+        'path': os.getenv('MIRROR_PATH', 'mirrors')
     }
 }
@@ -0,0 +1,279 @@
+import itertools
+from collections import OrderedDict
+
+import numpy as np
+from shapely.geometry import shape
+
+
+__all__ = ['FeatureSet', 'as_featureset', 'MISSING']
+
+
+class _Missing(object):
+    '''
+    Placeholder for a property that a feature did not have
+    '''
+
+    def __repr__(self):
+        return 'MISSING'
+
+    def __reduce__(self):
+        return (_missing, ())
+
+
+def _missing():
+    return MISSING
+
+
+MISSING = _Missing()
+
+_TYPED_KINDS = (bool, int, float, str)
+
+
+def _object_array(values):
+    values = list(values)
+    arr = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        arr[i] = value
+    return arr
+
+
+def _column(values):
+    '''
+    Store property values in a typed numpy array when every value has the
+    same scalar type, otherwise in an object array
+    '''
+    if isinstance(values, np.ndarray):
+        return values
+
+    values = list(values)
+    kinds = set(type(v) for v in values)
+    if len(kinds) == 1 and kinds.pop() in _TYPED_KINDS:
+        try:
+            return np.array(values)
+        except OverflowError:
+            pass
+    return _object_array(values)
+
+
+def _concat_columns(columns):
+    if all(col.dtype != object for col in columns):
+        kinds = set(col.dtype.kind for col in columns)
+        if len(kinds) == 1:
+            return np.concatenate(columns)
+    return _object_array(itertools.chain.from_iterable(
+        col.tolist() for col in columns))
+
+
+class FeatureSet(object):
+    '''
+    Columnar set of features: an object array of shapely geometries, one
+    numpy array per property and an optional GeoJSON crs block.
+
+    valid is True once every geometry is known to be valid, so overlays
+    can skip their own validity checks. grid_size is set when every
+    coordinate has been snapped to a precision grid of that size, in the
+    units of the featureset's frame, and overlays then run on that grid
+    '''
+
+    def __init__(self, geometry=(), properties=None, crs=None,
+                 type='FeatureCollection', valid=False, grid_size=None):
+        self.geometry = (geometry if isinstance(geometry, np.ndarray) and
+                         geometry.dtype == object else
+                         _object_array(geometry))
+        self.properties = OrderedDict()
+        for name, values in (properties or {}).items():
+            col = _column(values)
+            if len(col) != len(self.geometry):
+                raise ValueError('property column {} has {} values for {} '
+                                 'geometries'.format(name, len(col),
+                                                     len(self.geometry)))
+            self.properties[name] = col
+        self.crs = crs
+        self.type = type
+        self.valid = valid
+        self.grid_size = grid_size
+
+    def __len__(self):
+        return len(self.geometry)
+
+    def __repr__(self):
+        return '<FeatureSet: {} features, properties={}>'.format(
+            len(self), list(self.properties.keys()))
+
+    # ------------------- dict-shaped access at the graph boundary ---------
+
+    @classmethod
+    def from_dict(cls, featureset):
+        '''
+        Build a FeatureSet from a GeoJSON-shaped dict whose geometries are
+        either shapely objects or GeoJSON geometry mappings
+        '''
+        features = featureset['features']
+        geometry = [f['geometry'] if hasattr(f['geometry'], 'geom_type')
+                    else shape(f['geometry']) for f in features]
+
+        names = OrderedDict()
+        for f in features:
+            for name in (f.get('properties') or {}):
+                names[name] = None
+
+        properties = OrderedDict()
+        for name in names:
+            properties[name] = [(f.get('properties') or {}).get(name,
+                                                                 MISSING)
+                                for f in features]
+
+        return cls(geometry, properties, crs=featureset.get('crs'),
+                   type=featureset.get('type', 'FeatureCollection'))
+
+    def to_features(self, geometry=None):
+        '''
+        List of GeoJSON-shaped feature dicts. Geometries are the shapely
+        objects unless a converted geometry sequence is passed in
+        '''
+        geometry = self.geometry if geometry is None else geometry
+        columns = [(name, col.tolist())
+                   for name, col in self.properties.items()]
+        features = []
+        for i, geom in enumerate(geometry):
+            properties = {}
+            for name, values in columns:
+                if values[i] is not MISSING:
+                    properties[name] = values[i]
+            features.append(dict(type='Feature', geometry=geom,
+                                 properties=properties))
+        return features
+
+    def to_dict(self, geometry=None):
+        '''
+        GeoJSON-shaped dict of this featureset
+        '''
+        featureset = dict(type=self.type,
+                          features=self.to_features(geometry))
+        if self.crs is not None:
+            featureset['crs'] = self.crs
+        return featureset
+
+    def keys(self):
+        keys = ['type', 'features']
+        if self.crs is not None:
+            keys.append('crs')
+        return keys
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __getitem__(self, key):
+        if key == 'features':
+            return self.to_features()
+        elif key == 'type':
+            return self.type
+        elif key == 'crs' and self.crs is not None:
+            return self.crs
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    # ------------------------------ columns --------------------------------
+
+    def record(self, i):
+        '''
+        Properties of a single feature as a dict
+        '''
+        properties = {}
+        for name, col in self.properties.items():
+            value = col[i]
+            if value is MISSING:
+                continue
+            properties[name] = (value.item() if isinstance(value, np.generic)
+                                else value)
+        return properties
+
+    def has_property(self, name):
+        '''
+        True if every feature has a value for the property
+        '''
+        if name not in self.properties:
+            return False
+        col = self.properties[name]
+        return col.dtype != object or not any(v is MISSING for v in col)
+
+    def take(self, indices):
+        '''
+        New featureset holding the features at the given indices
+        '''
+        indices = np.asarray(indices, dtype=np.intp)
+        properties = OrderedDict((name, col[indices])
+                                 for name, col in self.properties.items())
+        return FeatureSet(self.geometry[indices], properties, crs=self.crs,
+                          type=self.type, valid=self.valid,
+                          grid_size=self.grid_size)
+
+    def with_geometry(self, geometry, crs=None, valid=False, grid_size=None):
+        '''
+        New featureset sharing this featureset's properties but with new
+        geometries, and optionally a new crs block
+        '''
+        return FeatureSet(geometry, self.properties,
+                          crs=self.crs if crs is None else crs,
+                          type=self.type, valid=valid, grid_size=grid_size)
+
+    @classmethod
+    def concat(cls, featuresets):
+        '''
+        Stack featuresets into one, filling properties a featureset does
+        not have with MISSING
+        '''
+        featuresets = list(featuresets)
+        if not featuresets:
+            return cls()
+
+        names = OrderedDict()
+        for fs in featuresets:
+            for name in fs.properties:
+                names[name] = None
+
+        properties = OrderedDict()
+        for name in names:
+            properties[name] = _concat_columns([
+                fs.properties[name] if name in fs.properties else
+                _object_array([MISSING] * len(fs)) for fs in featuresets])
+
+        geometry = np.concatenate([fs.geometry for fs in featuresets])
+        first = featuresets[0]
+        grid_sizes = set(fs.grid_size for fs in featuresets)
+        return cls(geometry, properties, crs=first.crs, type=first.type,
+                   valid=all(fs.valid for fs in featuresets),
+                   grid_size=grid_sizes.pop() if len(grid_sizes) == 1
+                   else None)
+
+
+def merge_properties(right, left):
+    '''
+    Combine two sets of equal-length property columns the way
+    {**right, **left} combines property dicts: left values win, except
+    where the left feature does not have the property
+    '''
+    properties = OrderedDict(right)
+    for name, col in left.items():
+        if name in properties and col.dtype == object:
+            missing = np.array([v is MISSING for v in col], dtype=bool)
+            if missing.any():
+                col = _object_array(col.tolist())
+                col[missing] = _object_array(
+                    properties[name][missing].tolist())
+        properties[name] = col
+    return properties
+
+
+def as_featureset(featureset):
+    '''
+    Accept either a FeatureSet or a GeoJSON-shaped dict
+    '''
+    if isinstance(featureset, FeatureSet):
+        return featureset
+    if isinstance(featureset, dict) and 'features' in featureset:
+        return FeatureSet.from_dict(featureset)
+    raise ValueError('featureset must be a FeatureSet or a dictionary ' +
+                     'with a features property')
@@ -0,0 +1,238 @@
+import codecs
+import json
+import re
+from bisect import bisect_right
+from collections import OrderedDict
+
+import numpy as np
+import shapely
+
+from polyIntersect.micro_functions.featureset import FeatureSet, MISSING
+
+
+__all__ = ['read_featureset']
+
+CHUNK_SIZE = 1 << 20
+BATCH_SIZE = 1000
+
+# a coordinates array only holds numbers, brackets, commas and whitespace
+_COORDINATES = re.compile(r'"coordinates"\s*:\s*(\[[-+0-9.eE,\s\[\]]*\])')
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+_decoder = json.JSONDecoder()
+
+
+class _Buffer(object):
+    '''
+    Text read so far from a str, bytes or file-like source. Consumed text
+    is dropped whenever more is read
+    '''
+
+    def __init__(self, source, chunk_size):
+        self.chunk_size = chunk_size
+        self.pos = 0
+        if hasattr(source, 'read'):
+            self.source = source
+            self.text = ''
+            self.eof = False
+            self.decode = codecs.getincrementaldecoder('utf-8')().decode
+        else:
+            self.source = None
+            self.text = (source.decode('utf-8') if isinstance(source, bytes)
+                         else source)
+            self.eof = True
+
+    def fill(self):
+        '''
+        Read at least as much again as is left unconsumed, so a value larger
+        than a chunk is decoded in a few attempts rather than one per chunk
+        '''
+        chunk = self.source.read(max(self.chunk_size,
+                                     len(self.text) - self.pos))
+        if isinstance(chunk, bytes):
+            chunk = self.decode(chunk, final=not chunk)
+        if not chunk:
+            self.eof = True
+        self.text = self.text[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if self.eof:
+                return ''
+            self.fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('invalid geojson: expected {!r} at {!r}'.format(
+                char, self.text[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+                # a number may continue in the next chunk
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+class _Skeleton(object):
+    '''
+    Text with every coordinates array replaced by its index in spans, so
+    the rest of each feature can be decoded without turning coordinates
+    into python floats
+    '''
+
+    def __init__(self, text, start):
+        parts = []
+        self.spans = []
+        self.ends = []
+        self.raw_ends = []
+        last = start
+        length = 0
+        for match in _COORDINATES.finditer(text, start):
+            parts.append(text[last:match.start(1)])
+            parts.append(str(len(self.spans)))
+            length += match.start(1) - last + len(parts[-1])
+            self.spans.append(match.group(1))
+            self.ends.append(length)
+            self.raw_ends.append(match.end(1))
+            last = match.end(1)
+        parts.append(text[last:])
+        self.text = ''.join(parts)
+        self.start = start
+
+    def raw_position(self, pos):
+        i = bisect_right(self.ends, pos) - 1
+        if i < 0:
+            return self.start + pos
+        return self.raw_ends[i] + pos - self.ends[i]
+
+    def span_count(self, start, end):
+        return bisect_right(self.ends, end) - bisect_right(self.ends, start)
+
+
+def _geometry_text(geometry, spans):
+    '''
+    GeoJSON text of a decoded skeleton geometry, with its coordinates put
+    back. Returns the number of spans used along with the text
+    '''
+    if geometry is None:
+        return None, 0
+    if geometry.get('type') == 'GeometryCollection':
+        parts = [_geometry_text(g, spans) for g in geometry['geometries']]
+        return ('{"type":"GeometryCollection","geometries":[' +
+                ','.join(text for text, _ in parts) + ']}',
+                sum(used for _, used in parts))
+    return ('{"type":"' + geometry['type'] + '","coordinates":' +
+            spans[geometry['coordinates']] + '}', 1)
+
+
+def _read_features(buf, batch_size):
+    '''
+    Stream the members of a features array. Returns the geometry array and
+    the list of property dicts
+    '''
+    batches = []
+    texts = []
+    properties = []
+
+    buf.expect('[')
+    while True:
+        skeleton = _Skeleton(buf.text, buf.pos)
+        text = skeleton.text
+        pos = 0
+        done = False
+        while True:
+            pos = _WHITESPACE.match(text, pos).end()
+            if text[pos:pos + 1] == ',':
+                pos = _WHITESPACE.match(text, pos + 1).end()
+            if text[pos:pos + 1] == ']':
+                pos += 1
+                done = True
+                break
+            try:
+                feature, end = _decoder.raw_decode(text, pos)
+            except ValueError:
+                break
+
+            geometry, used = _geometry_text(feature.get('geometry'),
+                                            skeleton.spans)
+            if used != skeleton.span_count(pos, end):
+                # a property was itself called coordinates
+                feature = json.loads(buf.text[skeleton.raw_position(pos):
+                                              skeleton.raw_position(end)])
+            texts.append(geometry)
+            properties.append(feature.get('properties') or {})
+            pos = end
+
+            if len(texts) == batch_size:
+                batches.append(shapely.from_geojson(texts))
+                texts = []
+
+        buf.pos = skeleton.raw_position(pos)
+        if done:
+            break
+        if buf.eof:
+            raise ValueError('invalid geojson: features array is truncated')
+        buf.fill()
+
+    if texts:
+        batches.append(shapely.from_geojson(texts))
+    geometry = (np.concatenate(batches) if batches else
+                np.empty(0, dtype=object))
+    return geometry, properties
+
+
+def read_featureset(source, batch_size=BATCH_SIZE, chunk_size=CHUNK_SIZE,
+                    members=None):
+    '''
+    Parse a GeoJSON FeatureCollection from a str, bytes or file-like object
+    into a FeatureSet without ever holding the whole document as python
+    objects. Features are decoded one at a time as the source is read,
+    coordinates are handed to GEOS as text, and geometries are built in
+    batches of batch_size. If a members dict is passed in, it receives the
+    document's other top-level members, such as exceededTransferLimit
+    '''
+    buf = _Buffer(source, chunk_size)
+    if buf.peek() != '{':
+        raise ValueError('input json must be dictionary')
+    buf.expect('{')
+
+    members = {} if members is None else members
+    geometry = None
+    properties = None
+    while buf.peek() != '}':
+        key = buf.value()
+        buf.expect(':')
+        if key == 'features':
+            geometry, properties = _read_features(buf, batch_size)
+        else:
+            members[key] = buf.value()
+        if buf.peek() == ',':
+            buf.pos += 1
+    buf.expect('}')
+
+    if geometry is None:
+        raise ValueError('input json must contain features property')
+
+    names = OrderedDict()
+    for props in properties:
+        for name in props:
+            names[name] = None
+    columns = OrderedDict(
+        (name, [props.get(name, MISSING) for props in properties])
+        for name in names)
+
+    return FeatureSet(geometry, columns, crs=members.get('crs'),
+                      type=members.get('type', 'FeatureCollection'))
@@ -0,0 +1,269 @@
+import json
+import os
+import sqlite3
+import struct
+from collections import OrderedDict
+
+import numpy as np
+import shapely
+
+from polyIntersect.micro_functions.featureset import FeatureSet, MISSING
+
+
+__all__ = ['write_geopackage', 'read_geopackage']
+
+GEOMETRY_COLUMN = 'geom'
+
+# 'GPKG' as a big endian integer
+APPLICATION_ID = 0x47504B47
+USER_VERSION = 10200
+
+WGS84_WKT = ('GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,'
+             '298.257223563,AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG",'
+             '"6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],'
+             'UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],'
+             'AUTHORITY["EPSG","4326"]]')
+
+_SCHEMA = '''
+CREATE TABLE gpkg_spatial_ref_sys (
+    srs_name TEXT NOT NULL,
+    srs_id INTEGER NOT NULL PRIMARY KEY,
+    organization TEXT NOT NULL,
+    organization_coordsys_id INTEGER NOT NULL,
+    definition TEXT NOT NULL,
+    description TEXT
+);
+CREATE TABLE gpkg_contents (
+    table_name TEXT NOT NULL PRIMARY KEY,
+    data_type TEXT NOT NULL,
+    identifier TEXT UNIQUE,
+    description TEXT DEFAULT '',
+    last_change DATETIME NOT NULL DEFAULT
+        (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+    min_x DOUBLE,
+    min_y DOUBLE,
+    max_x DOUBLE,
+    max_y DOUBLE,
+    srs_id INTEGER
+);
+CREATE TABLE gpkg_geometry_columns (
+    table_name TEXT NOT NULL,
+    column_name TEXT NOT NULL,
+    geometry_type_name TEXT NOT NULL,
+    srs_id INTEGER NOT NULL,
+    z TINYINT NOT NULL,
+    m TINYINT NOT NULL,
+    PRIMARY KEY (table_name, column_name)
+);
+CREATE TABLE gpkg_extensions (
+    table_name TEXT,
+    column_name TEXT,
+    extension_name TEXT NOT NULL,
+    definition TEXT NOT NULL,
+    scope TEXT NOT NULL
+);
+CREATE TABLE gpkg_data_columns (
+    table_name TEXT NOT NULL,
+    column_name TEXT NOT NULL,
+    name TEXT,
+    title TEXT,
+    description TEXT,
+    mime_type TEXT,
+    constraint_name TEXT,
+    PRIMARY KEY (table_name, column_name)
+);
+'''
+
+# mime type of columns holding JSON text, in gpkg_data_columns
+JSON_MIME_TYPE = 'application/json'
+
+# bytes of envelope for each value of the envelope bits of a blob's flags
+_ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+
+def _quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _sql_type(column):
+    if column.dtype.kind in 'biu':
+        return 'INTEGER'
+    if column.dtype.kind == 'f':
+        return 'REAL'
+    return 'TEXT'
+
+
+def _scalar(value):
+    return value is MISSING or value is None or isinstance(
+        value, (bool, int, float, str, np.generic))
+
+
+def _sql_value(value, as_json=False):
+    if value is MISSING or value is None:
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if as_json:
+        return json.dumps(value)
+    return value
+
+
+def _blob(geom, wkb):
+    '''
+    GeoPackage binary geometry: header with srs id and xy envelope,
+    followed by the WKB
+    '''
+    if geom is None or shapely.is_empty(geom):
+        return b'GP\x00\x11' + struct.pack('<i', 4326) + (
+            wkb if wkb is not None else
+            shapely.to_wkb(shapely.GeometryCollection()))
+    xmin, ymin, xmax, ymax = shapely.bounds(geom)
+    return (b'GP\x00\x03' + struct.pack('<i4d', 4326, xmin, xmax, ymin, ymax) +
+            wkb)
+
+
+def _wkb(blob):
+    flags = blob[3]
+    return blob[8 + _ENVELOPE_SIZES[(flags >> 1) & 7]:]
+
+
+def write_geopackage(path, table, featureset):
+    '''
+    Write a featureset in WGS84 to a new GeoPackage with an rtree spatial
+    index. The file is written next to path and moved into place once
+    complete, so readers never see a partial mirror
+    '''
+    partial = path + '.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+
+    db = sqlite3.connect(partial)
+    try:
+        db.execute('PRAGMA application_id = {}'.format(APPLICATION_ID))
+        db.execute('PRAGMA user_version = {}'.format(USER_VERSION))
+        db.executescript(_SCHEMA)
+        db.executemany(
+            'INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)', [
+                ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined',
+                 None),
+                ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined',
+                 None),
+                ('WGS 84 geodetic', 4326, 'EPSG', 4326, WGS84_WKT, None)])
+
+        columns = [(name, col) for name, col in featureset.properties.items()
+                   if name.lower() not in ('fid', GEOMETRY_COLUMN)]
+        db.execute('CREATE TABLE {} (fid INTEGER PRIMARY KEY AUTOINCREMENT, '
+                   '{} GEOMETRY{})'.format(
+                       _quote(table), GEOMETRY_COLUMN,
+                       ''.join(', {} {}'.format(_quote(name), _sql_type(col))
+                               for name, col in columns)))
+
+        rtree = _quote('rtree_{}_{}'.format(table, GEOMETRY_COLUMN))
+        db.execute('CREATE VIRTUAL TABLE {} USING '
+                   'rtree(id, minx, maxx, miny, maxy)'.format(rtree))
+
+        geometry = featureset.geometry
+        wkb = shapely.to_wkb(geometry)
+        bounds = shapely.bounds(geometry)
+        values = [col.tolist() for _, col in columns]
+        # columns with any list or dict value hold JSON text throughout
+        as_json = [col.dtype.kind == 'O' and
+                   not all(_scalar(value) for value in col_values)
+                   for (_, col), col_values in zip(columns, values)]
+        db.executemany(
+            'INSERT INTO {} VALUES (?, ?{})'.format(
+                _quote(table), ', ?' * len(columns)),
+            ((i + 1, _blob(geometry[i], wkb[i])) +
+             tuple(_sql_value(col[i], json_col)
+                   for col, json_col in zip(values, as_json))
+             for i in range(len(featureset))))
+        db.executemany(
+            'INSERT INTO {} VALUES (?, ?, ?, ?, ?)'.format(rtree),
+            ((i + 1, xmin, xmax, ymin, ymax)
+             for i, (xmin, ymin, xmax, ymax) in enumerate(bounds.tolist())
+             if not np.isnan(xmin)))
+
+        if len(featureset):
+            xmin, ymin = np.nanmin(bounds[:, :2], axis=0).tolist()
+            xmax, ymax = np.nanmax(bounds[:, 2:], axis=0).tolist()
+        else:
+            xmin = ymin = xmax = ymax = None
+        db.execute('INSERT INTO gpkg_contents (table_name, data_type, '
+                   'identifier, min_x, min_y, max_x, max_y, srs_id) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                   (table, 'features', table, xmin, ymin, xmax, ymax, 4326))
+        db.execute('INSERT INTO gpkg_geometry_columns VALUES '
+                   '(?, ?, ?, ?, ?, ?)',
+                   (table, GEOMETRY_COLUMN, 'GEOMETRY', 4326, 0, 0))
+        db.execute('INSERT INTO gpkg_extensions VALUES (?, ?, ?, ?, ?)',
+                   (table, GEOMETRY_COLUMN, 'gpkg_rtree_index',
+                    'http://www.geopackage.org/spec120/#extension_rtree',
+                    'write-only'))
+        db.executemany(
+            'INSERT INTO gpkg_data_columns (table_name, column_name, name, '
+            'mime_type) VALUES (?, ?, ?, ?)',
+            [(table, name, name, JSON_MIME_TYPE)
+             for (name, _), json_col in zip(columns, as_json) if json_col])
+        db.execute('INSERT INTO gpkg_extensions VALUES (?, ?, ?, ?, ?)',
+                   ('gpkg_data_columns', None, 'gpkg_schema',
+                    'http://www.geopackage.org/spec120/#extension_schema',
+                    'read-write'))
+        db.commit()
+    finally:
+        db.close()
+    os.replace(partial, path)
+
+
+def read_geopackage(path, geoms, out_fields=(), where='1=1'):
+    '''
+    Features of the first feature table of a GeoPackage whose bounding
+    boxes overlap those of the geometries, found through the table's rtree
+    index. Only the properties named in out_fields are read, along with
+    objectid if the table has one, and features can be filtered further by
+    a SQL where clause on the table's columns
+    '''
+    db = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    try:
+        table, column = db.execute(
+            'SELECT table_name, column_name FROM gpkg_geometry_columns'
+        ).fetchone()
+        names = [row[1] for row in db.execute(
+            'PRAGMA table_info({})'.format(_quote(table)))]
+        lower = dict((name.lower(), name) for name in names)
+        fields = [lower[field.lower()] for field in
+                  ['objectid'] + [f for f in out_fields if f != 'objectid']
+                  if field and field.lower() in lower]
+        # columns marked as JSON text, in mirrors that mark them
+        json_fields = set()
+        if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                      "AND name = 'gpkg_data_columns'").fetchone():
+            json_fields.update(row[0] for row in db.execute(
+                'SELECT column_name FROM gpkg_data_columns WHERE '
+                'table_name = ? AND mime_type = ?', (table, JSON_MIME_TYPE)))
+
+        db.execute('CREATE TEMP TABLE hits (fid INTEGER PRIMARY KEY)')
+        db.executemany(
+            'INSERT OR IGNORE INTO hits SELECT id FROM {} WHERE '
+            'minx <= ? AND maxx >= ? AND miny <= ? AND maxy >= ?'.format(
+                _quote('rtree_{}_{}'.format(table, column))),
+            ((xmax, xmin, ymax, ymin) for xmin, ymin, xmax, ymax in
+             shapely.bounds(geoms).tolist() if not np.isnan(xmin)))
+
+        rows = db.execute(
+            'SELECT t.{}{} FROM {} AS t JOIN hits ON t.fid = hits.fid '
+            'WHERE ({}) ORDER BY t.fid'.format(
+                _quote(column),
+                ''.join(', t.{}'.format(_quote(f)) for f in fields),
+                _quote(table), where or '1=1')).fetchall()
+    finally:
+        db.close()
+
+    geometry = shapely.from_wkb([_wkb(row[0]) if row[0] is not None
+                                 else None for row in rows])
+    geometry[shapely.is_empty(geometry)] = None
+    properties = OrderedDict(
+        (field, [json.loads(row[i + 1])
+                 if field in json_fields and row[i + 1] is not None
+                 else row[i + 1] for row in rows])
+        for i, field in enumerate(fields))
+    return FeatureSet(geometry, properties)
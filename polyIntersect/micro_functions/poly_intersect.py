@@ -1,73 +1,165 @@
+import os
 import json
-import itertools
-import rtree
+import multiprocessing
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from parse import search
 from geomet import wkt
 from datetime import datetime, timedelta
 
-from functools import partial, lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
 import pyproj
 import numpy as np
-from time import time
 
-from shapely.geometry import shape, mapping
-from shapely.geometry.polygon import Polygon
-from shapely.geometry.multipolygon import MultiPolygon
+import shapely
+from shapely import STRtree
+from shapely.geometry import mapping
 from shapely.geometry.collection import GeometryCollection
-from shapely.ops import unary_union, transform
+
+from polyIntersect.config import SETTINGS
+from polyIntersect.micro_functions.featureset import FeatureSet
+from polyIntersect.micro_functions.featureset import as_featureset
+from polyIntersect.micro_functions.featureset import merge_properties
+from polyIntersect.micro_functions.geojson_reader import read_featureset
+from polyIntersect.micro_functions.mirror import read_geopackage
+from polyIntersect.micro_functions.mirror import write_geopackage
+from polyIntersect.micro_functions.tile_cache import get_tile_cache
+from polyIntersect.micro_functions.tile_cache import tile_bounds
+from polyIntersect.micro_functions.tile_cache import tiles_for
+from polyIntersect.serializers import featureset_json
 
 
 __all__ = ['json2ogr', 'ogr2json', 'dissolve', 'intersect', 'project_local',
            'project_global', 'buffer_to_dist', 'get_area', 'get_area_percent',
            'esri_server2ogr', 'get_species_count', 'esri_server2histo',
            'esri_count_groupby', 'cartodb2ogr', 'esri_count_30days',
-           'esri_last_instance', 'erase']
+           'esri_last_instance', 'erase', 'repair', 'split', 'select',
+           'intersect_area', 'get_area_percent_from_area',
+           'get_geodesic_area', 'projection_frame', 'buffer_rings', 'clip',
+           'simplify', 'simplify_error']
 
 HA_CONVERSION = 10000
-t0 = 0
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_E2 = 0.0066943799901413165
+
+# quadtree levels before subdivide gives up on a piece
+SUBDIVIDE_MAX_DEPTH = 16
 
 
-def json2ogr(in_json):
+class TimeoutHTTPAdapter(HTTPAdapter):
     '''
-    Convert geojson object to GDAL geometry
+    HTTPAdapter that applies a default timeout to every request sent
+    without one
     '''
 
-    if isinstance(in_json, str):
-        in_json = json.loads(in_json)
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
 
-    if not isinstance(in_json, dict):
-        raise ValueError('input json must be dictionary')
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
 
-    if 'features' not in in_json.keys():
-        raise ValueError('input json must contain features property')
 
-    for f in in_json['features']:
-        f['geometry'] = shape(f['geometry'])
+_session = None
+_session_pid = None
 
-    for i in range(len(in_json['features'])):
-        in_json['features'][i]['properties']['id'] = i
 
-    return in_json
+def get_session():
+    '''
+    Keep-alive HTTP session for upstream services, created once per worker
+    process, so repeated calls to the same ArcGIS and Carto hosts reuse
+    their connections. Pool sizes, retries and timeouts come from
+    SETTINGS['http']
+    '''
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        settings = SETTINGS['http']
+        adapter = TimeoutHTTPAdapter(
+            timeout=(settings['connect_timeout'], settings['read_timeout']),
+            pool_connections=settings['pool_connections'],
+            pool_maxsize=settings['pool_maxsize'],
+            max_retries=settings['max_retries'])
+        _session = requests.Session()
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+        _session_pid = os.getpid()
+    return _session
+
+
+def json2ogr(in_json, repair_geometry=True, grid_size=None):
+    '''
+    Convert geojson object to a FeatureSet of shapely geometries, repairing
+    invalid geometries unless repair_geometry is False. If grid_size is
+    given, coordinates are also snapped to a precision grid of that size.
+
+    Geojson text, bytes or a file-like object such as a streamed response
+    is parsed incrementally
+    '''
+
+    if isinstance(in_json, (str, bytes)) or hasattr(in_json, 'read'):
+        featureset = read_featureset(in_json)
+    else:
+        if not isinstance(in_json, dict):
+            raise ValueError('input json must be dictionary')
+
+        if 'features' not in in_json.keys():
+            raise ValueError('input json must contain features property')
+
+        featureset = FeatureSet.from_dict(in_json)
+
+    featureset.properties['id'] = np.arange(len(featureset))
+
+    if grid_size:
+        featureset = snap_to_grid(featureset, grid_size)
+    elif repair_geometry:
+        featureset = repair(featureset)
+    return featureset
+
+
+def snap_to_grid(featureset, grid_size):
+    '''
+    Repair a featureset and round every coordinate to a precision grid.
+    Overlays of gridded featuresets run with the same fixed precision, so
+    near-coincident edges are merged up front rather than causing slow or
+    failing overlays
+    '''
+    grid_size = float(grid_size)
+    featureset = repair(featureset)
+    geoms = shapely.set_precision(featureset.geometry, grid_size)
+    return featureset.with_geometry(geoms, valid=True, grid_size=grid_size)
+
+
+def overlay_grid(*featuresets):
+    '''
+    Precision grid for an overlay of featuresets in the same frame: the
+    coarsest grid any of them was snapped to, or None for full precision
+    '''
+    grid_sizes = [fs.grid_size for fs in featuresets if fs.grid_size]
+    return max(grid_sizes) if grid_sizes else None
 
 
 def ogr2json(featureset):
     '''
-    Convert GDAL geometry to geojson object
+    Convert a FeatureSet of shapely geometries to a geojson string
     '''
+    return featureset_json(as_featureset(featureset))
 
-    new_features = []
-    for f in featureset['features']:
-        new_features.append(dict(geometry=mapping(f['geometry']),
-                                 properties=f['properties'],
-                                 type=f['type']))
-        # f['geometry'] = mapping(f['geometry'])
 
-    new_featureset = dict(type=featureset['type'],
-                          features=new_features)
-    if 'crs' in featureset.keys():
-        new_featureset['crs'] = featureset['crs']
-    return json.dumps(new_featureset)
+def load_geojson(in_json):
+    '''
+    Load a geojson string or FeatureSet as a geojson dictionary
+    '''
+    if isinstance(in_json, str):
+        return json.loads(in_json)
+    if isinstance(in_json, FeatureSet):
+        return in_json.to_dict([mapping(geom) for geom in in_json.geometry])
+    return in_json
 
 
 def explode(coords):
@@ -95,8 +187,65 @@ def bbox(f):
              [x1, y1]]]
 
 
+def tile_rings(tile):
+    '''
+    Polygon rings of a cache tile, in the form bbox returns
+    '''
+    x1, y1, x2, y2 = tile_bounds(tile)
+    return [[[x1, y1], [x2, y1], [x2, y2], [x1, y2], [x1, y1]]]
+
+
+def cached_tiles(cache, layer, where, fields, key, aoi, fetch):
+    '''
+    Features of a reference layer in the cache tiles that cover an aoi,
+    each once by the value of its key property. Tiles missing from the
+    cache are fetched with fetch, which takes a list of tile ids and
+    returns a dict of featuresets by tile id, and are then cached
+    '''
+    if isinstance(aoi, FeatureSet):
+        geoms = aoi.geometry
+    else:
+        geoms = json2ogr(aoi, repair_geometry=False).geometry
+    tiles = tiles_for(geoms, SETTINGS['tile_cache']['zoom'])
+
+    found, featureset = cache.get(layer, where, fields, tiles)
+    missing = [tile for tile in tiles if tile not in found]
+    if missing:
+        fetched = fetch(missing)
+        cache.put(layer, where, fields, fetched, key)
+        featureset = FeatureSet.concat(
+            [featureset] + [fetched[tile] for tile in missing])
+    return drop_duplicates(featureset, key)
+
+
+def cache_layer(provider, endpoint):
+    '''
+    Name a reference layer's tiles are cached under
+    '''
+    if provider == 'esri:server':
+        return endpoint.replace('?f=pjson', '') + '/query'
+    return endpoint
+
+
+def drop_duplicates(featureset, name):
+    '''
+    Keep the first feature for each value of a property, if the featureset
+    has it
+    '''
+    if name not in featureset.properties:
+        return featureset
+    seen = set()
+    keep = []
+    for i, value in enumerate(featureset.properties[name].tolist()):
+        if value not in seen:
+            seen.add(value)
+            keep.append(i)
+    return featureset.take(keep)
+
+
 @lru_cache(5)
-def esri_server2ogr(layer_endpoint, aoi, out_fields, where='1=1'):
+def esri_server2ogr(layer_endpoint, aoi, out_fields, where='1=1',
+                    grid_size=None):
 
     url = layer_endpoint.replace('?f=pjson', '') + '/query'
 
@@ -111,31 +260,83 @@ def esri_server2ogr(layer_endpoint, aoi, out_fields, where='1=1'):
     params['f'] = 'geojson'
     params['geometryType'] = 'esriGeometryPolygon'
     params['spatialRel'] = 'esriSpatialRelIntersects'
+    # a stable order is needed to page through results
+    params['orderByFields'] = 'objectid'
     # params['geometry'] = str({'rings': bbox(json.loads(aoi)['features'][0]),
     #                           'spatialReference': {'wkid': 4326}})
 
-    # iterate through aoi features (Esri does not accept multipart polygons
-    # as a spatial filter, and the aoi features may be too far apart to combine
-    # into one bounding box)
-    featureset = {}
-    objectids = []
-    for f in json.loads(aoi)['features']:
-        params['geometry'] = str({'rings': bbox(f),
-                                  'spatialReference': {'wkid': 4326}})
-        req = requests.post(url, data=params)
+    def query_page(geometry, offset=0):
+        page_params = dict(params, geometry=geometry)
+        if offset:
+            page_params['resultOffset'] = offset
+        members = {}
+        with get_session().post(url, data=page_params, stream=True) as req:
+            req.raise_for_status()
+            req.raw.decode_content = True
+            page = read_featureset(req.raw, members=members)
+        exceeded = (members.get('exceededTransferLimit') or
+                    (members.get('properties') or {}).get(
+                        'exceededTransferLimit'))
+        return page, bool(exceeded)
+
+    def query_count(geometry):
+        count_params = dict(params, geometry=geometry, f='json',
+                            returnCountOnly=True, returnGeometry=False)
+        del count_params['orderByFields']
+        req = get_session().post(url, data=count_params)
         req.raise_for_status()
-        response = json2ogr(req.text)
-
-        # append response to full dataset, except features already included
-        if featureset:
-            for h in response['features']:
-                if h['properties']['objectid'] not in objectids:
-                    featureset['features'].append(h)
-                    objectids.append(h['properties']['objectid'])
-        else:
-            featureset = response
+        return req.json()['count']
+
+    def query_all(geometries):
+        workers = max(1, min(SETTINGS['esri']['workers'],
+                             len(geometries) or 1))
+        with ThreadPoolExecutor(workers) as executor:
+            first_pages = list(executor.map(query_page, geometries))
+
+            truncated = [i for i, (page, exceeded) in enumerate(first_pages)
+                         if exceeded and len(page)]
+            counts = executor.map(query_count,
+                                  [geometries[i] for i in truncated])
+            offsets = [(i, offset) for i, count in zip(truncated, counts)
+                       for offset in range(len(first_pages[i][0]), count,
+                                           len(first_pages[i][0]))]
+            more_pages = list(executor.map(
+                lambda item: query_page(geometries[item[0]], item[1]),
+                offsets))
+
+        pages = [[page] for page, _ in first_pages]
+        for (i, _), (page, _) in zip(offsets, more_pages):
+            pages[i].append(page)
+        return [FeatureSet.concat(feature_pages) for feature_pages in pages]
+
+    def query_tiles(tiles):
+        return dict(zip(tiles, query_all([
+            str({'rings': tile_rings(tile),
+                 'spatialReference': {'wkid': 4326}}) for tile in tiles])))
+
+    # one query per aoi feature, or per cache tile the aoi covers (Esri does
+    # not accept multipart polygons as a spatial filter, and the aoi
+    # features may be too far apart to combine into one bounding box). The
+    # queries, and the extra pages of results the server's record limit cut
+    # off, are sent concurrently
+    cache = get_tile_cache()
+    if cache is not None:
+        featureset = cached_tiles(cache,
+                                  cache_layer('esri:server', layer_endpoint),
+                                  where, out_fields, 'objectid', aoi,
+                                  query_tiles)
+    else:
+        featureset = FeatureSet.concat(query_all([
+            str({'rings': bbox(f), 'spatialReference': {'wkid': 4326}})
+            for f in load_geojson(aoi)['features']]))
 
-    return featureset
+    # keep the first copy of features found by more than one query
+    featureset = drop_duplicates(featureset, 'objectid')
+
+    featureset.properties['id'] = np.arange(len(featureset))
+    if grid_size:
+        return snap_to_grid(featureset, grid_size)
+    return repair(featureset)
 
     # req = requests.post(url, data=params)
     # req.raise_for_status()
@@ -153,12 +354,12 @@ def esri_server2histo(layer_endpoint, aoi):
     params['returnGeometry'] = True
     params['where'] = '1=1'
 
-    featureset = json.loads(aoi) if isinstance(aoi, str) else aoi
+    featureset = load_geojson(aoi)
     if featureset['features']:
         f = featureset['features'][0]
         params['geometry'] = str({'rings': f['geometry']['coordinates'],
                                   'spatialReference': {'wkid': 4326}})
-        req = requests.post(url, data=params)
+        req = get_session().post(url, data=params)
         req.raise_for_status()
         histograms = req.json()['histograms'][0]['counts']
 
@@ -182,12 +383,12 @@ def esri_count_groupby(layer_endpoint, aoi, count_fields):
         'outStatisticFieldName': 'count'
     }])
 
-    featureset = json.loads(aoi) if isinstance(aoi, str) else aoi
+    featureset = load_geojson(aoi)
     if featureset['features']:
         f = featureset['features'][0]
         params['geometry'] = str({'rings': f['geometry']['coordinates'],
                                   'spatialReference': {'wkid': 4326}})
-        req = requests.post(url, data=params)
+        req = get_session().post(url, data=params)
         req.raise_for_status()
         try:
             counts = {'-'.join([str(item['attributes'][field]) for field in
@@ -213,12 +414,12 @@ def esri_count_30days(layer_endpoint, aoi, date_field):
     params['returnGeometry'] = False
     params['returnCountOnly'] = True
 
-    featureset = json.loads(aoi) if isinstance(aoi, str) else aoi
+    featureset = load_geojson(aoi)
     if featureset['features']:
         f = featureset['features'][0]
         params['geometry'] = str({'rings': f['geometry']['coordinates'],
                                   'spatialReference': {'wkid': 4326}})
-        req = requests.post(url, data=params)
+        req = get_session().post(url, data=params)
         req.raise_for_status()
         counts = req.json()['count']
 
@@ -239,12 +440,12 @@ def esri_last_instance(layer_endpoint, aoi, field):
     params['orderByFields'] = field
     params['returnDistinctValues'] = True
 
-    featureset = json.loads(aoi) if isinstance(aoi, str) else aoi
+    featureset = load_geojson(aoi)
     if featureset['features']:
         f = featureset['features'][0]
         params['geometry'] = str({'rings': f['geometry']['coordinates'],
                                   'spatialReference': {'wkid': 4326}})
-        req = requests.post(url, data=params)
+        req = get_session().post(url, data=params)
         req.raise_for_status()
         try:
             instances = [item['attributes'][field] for item in
@@ -258,279 +459,949 @@ def esri_last_instance(layer_endpoint, aoi, field):
 
 
 @lru_cache(5)
-def cartodb2ogr(service_endpoint, aoi, out_fields, where=''):
+def cartodb2ogr(service_endpoint, aoi, out_fields, where='', grid_size=None):
     endpoint_template = 'https://{}.carto.com/tables/{}/'
     username, table = search(endpoint_template, service_endpoint + '/')
     url = 'https://{username}.carto.com/api/v2/sql'.format(username=username)
 
-    featureset = json.loads(aoi) if isinstance(aoi, str) else aoi
+    cache = get_tile_cache()
 
-    params = {}
-    fields = ['ST_AsGeoJSON(the_geom) as geometry']
+    fields = ['the_geom']
     out_fields = out_fields.split(',')
+    # cached features are told apart by cartodb_id, which every carto
+    # table has
+    if cache is not None and 'cartodb_id' not in out_fields:
+        fields.append('cartodb_id')
     for field in out_fields:
         if field:
             fields.append('{field} as {field}'.format(field=field))
 
-    where_clause = "ST_Intersects(ST_Buffer({},0),the_geom)"
-    where_clause = where_clause.format("ST_GeomFromText('{}',4326)".format(
-        wkt.dumps({'type': 'MultiPolygon',
-                   'coordinates': [bbox(f) for f in featureset['features']]}
-                  )))
-    if where and not where == '1=1':
-        where_clause += 'AND {}'.format(where)
+    def query(rings):
+        where_clause = "ST_Intersects(ST_Buffer({},0),the_geom)"
+        where_clause = where_clause.format(
+            "ST_GeomFromText('{}',4326)".format(wkt.dumps(
+                {'type': 'MultiPolygon', 'coordinates': rings})))
+        if where and not where == '1=1':
+            where_clause += 'AND {}'.format(where)
+
+        q = 'SELECT {fields} FROM {table} WHERE {where}'
+        params = {'q': q.format(fields=','.join(fields), table=table,
+                  where=where_clause),
+                  'format': 'GeoJSON'}
+
+        try:
+            req = get_session().get(url, params=params, stream=True)
+            req.raise_for_status()
+        except Exception as e:
+            raise ValueError((e, rings))
+
+        # the SQL API returns the selected fields as geojson properties
+        with req:
+            req.raw.decode_content = True
+            return read_featureset(req.raw)
+
+    def query_tiles(tiles):
+        # one query for every missing tile, with the features then sorted
+        # into the tiles whose bounds they overlap
+        featureset = query([tile_rings(tile) for tile in tiles])
+        boxes = shapely.box(*np.array([tile_bounds(t) for t in tiles]).T)
+        tile_idx, feature_idx = STRtree(featureset.geometry).query(boxes)
+        order = np.lexsort((feature_idx, tile_idx))
+        tile_idx, feature_idx = tile_idx[order], feature_idx[order]
+        return dict((tile, featureset.take(feature_idx[tile_idx == i]))
+                    for i, tile in enumerate(tiles))
+
+    if cache is not None:
+        featureset = cached_tiles(cache,
+                                  cache_layer('cartodb', service_endpoint),
+                                  where, ','.join(fields), 'cartodb_id', aoi,
+                                  query_tiles)
+        if 'cartodb_id' not in out_fields:
+            # an empty result has no columns at all
+            featureset.properties.pop('cartodb_id', None)
+    else:
+        featureset = query([bbox(f) for f in load_geojson(aoi)['features']])
+
+    featureset.properties['id'] = np.arange(len(featureset))
+    if grid_size:
+        return snap_to_grid(featureset, grid_size)
+    return repair(featureset)
+
+
+def mirror2ogr(mirror_path, aoi, out_fields, where='1=1', grid_size=None):
+    '''
+    Reference features from a local GeoPackage mirror of a layer, in the
+    same shape esri_server2ogr and cartodb2ogr return: the features whose
+    bounding boxes overlap those of the aoi features, with the out_fields
+    properties. Reads are cached per version of the mirror file, so a
+    mirror synced by another process is read as soon as it is in place
+    '''
+    stat = os.stat(mirror_path)
+    return read_mirror(mirror_path,
+                       (stat.st_ino, stat.st_mtime_ns, stat.st_size),
+                       aoi, out_fields, where, grid_size)
+
+
+@lru_cache(5)
+def read_mirror(mirror_path, version, aoi, out_fields, where, grid_size):
+    if isinstance(aoi, FeatureSet):
+        geoms = aoi.geometry
+    else:
+        geoms = json2ogr(aoi, repair_geometry=False).geometry
+
+    featureset = read_geopackage(mirror_path, geoms, out_fields.split(','),
+                                 where)
+    featureset.properties['id'] = np.arange(len(featureset))
+    if grid_size:
+        return snap_to_grid(featureset, grid_size)
+    return repair(featureset)
 
-    q = 'SELECT {fields} FROM {table} WHERE {where}'
-    params = {'q': q.format(fields=','.join(fields), table=table,
-              where=where_clause)}
 
-    try:
-        req = requests.get(url, params=params)
+def esri_layer_features(layer_endpoint, where='1=1'):
+    '''
+    Every feature of an Esri layer with all its fields, paging through
+    the server's record limit
+    '''
+    url = layer_endpoint.replace('?f=pjson', '') + '/query'
+    params = {'where': where or '1=1', 'outFields': '*',
+              'returnGeometry': True, 'returnM': False, 'returnZ': False,
+              'orderByFields': 'objectid', 'f': 'geojson'}
+
+    pages = []
+    offset = 0
+    while True:
+        members = {}
+        with get_session().post(url, data=dict(params, resultOffset=offset),
+                                stream=True) as req:
+            req.raise_for_status()
+            req.raw.decode_content = True
+            page = read_featureset(req.raw, members=members)
+        pages.append(page)
+        offset += len(page)
+        exceeded = (members.get('exceededTransferLimit') or
+                    (members.get('properties') or {}).get(
+                        'exceededTransferLimit'))
+        if not exceeded or not len(page):
+            break
+    return FeatureSet.concat(pages)
+
+
+def cartodb_layer_features(service_endpoint, where=''):
+    '''
+    Every feature of a Carto table with all its columns
+    '''
+    endpoint_template = 'https://{}.carto.com/tables/{}/'
+    username, table = search(endpoint_template, service_endpoint + '/')
+    url = 'https://{username}.carto.com/api/v2/sql'.format(username=username)
+
+    q = 'SELECT * FROM {}'.format(table)
+    if where and not where == '1=1':
+        q += ' WHERE {}'.format(where)
+    with get_session().get(url, params={'q': q, 'format': 'GeoJSON'},
+                           stream=True) as req:
         req.raise_for_status()
-    except Exception as e:
-        raise ValueError((e, [bbox(f) for f in featureset['features']]))
-
-    response = json.loads(req.text)['rows']
-    features = {
-        'type': 'FeatureCollection',
-        'features': [{
-            'type': 'Feature',
-            'geometry': json.loads(feat['geometry']),
-            'properties': {field: feat[field] for field in out_fields if field}
-        } for feat in response]
-    }
-    global t0
-    t0 = time()
-    featureset = json2ogr(features)
-    # raise ValueError(time()-t0)
+        req.raw.decode_content = True
+        featureset = read_featureset(req.raw)
+    featureset.properties.pop('the_geom_webmercator', None)
     return featureset
 
 
-def dissolve(featureset, field=None):
+LAYER_FEATURES = {'esri:server': esri_layer_features,
+                  'cartodb': cartodb_layer_features}
+
+
+def sync_mirror(provider, endpoint, mirror_path):
+    '''
+    Download a whole Esri or Carto layer into a GeoPackage mirror,
+    replacing the previous copy once the new one is complete. Returns the
+    number of features mirrored
+    '''
+    featureset = LAYER_FEATURES[provider](endpoint)
+    directory = os.path.dirname(mirror_path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    table = os.path.splitext(os.path.basename(mirror_path))[0]
+    write_geopackage(mirror_path, table, featureset)
+    read_mirror.cache_clear()
+    return len(featureset)
+
+
+def esri_layer_version(layer_endpoint):
+    '''
+    Last edit time Esri reports for a layer, or None if the layer does not
+    track edits
+    '''
+    url = layer_endpoint.replace('?f=pjson', '')
+    req = get_session().get(url, params={'f': 'json'})
+    req.raise_for_status()
+    edited = (req.json().get('editingInfo') or {}).get('lastEditDate')
+    return str(edited) if edited is not None else None
+
+
+def cartodb_layer_version(service_endpoint):
+    '''
+    Last update time Carto records for a table
+    '''
+    endpoint_template = 'https://{}.carto.com/tables/{}/'
+    username, table = search(endpoint_template, service_endpoint + '/')
+    url = 'https://{username}.carto.com/api/v2/sql'.format(username=username)
+
+    q = ("SELECT updated_at FROM CDB_TableMetadata "
+         "WHERE tabname = '{}'::regclass").format(table)
+    req = get_session().get(url, params={'q': q})
+    req.raise_for_status()
+    rows = req.json().get('rows') or []
+    return str(rows[0]['updated_at']) if rows else None
+
+
+LAYER_VERSIONS = {'esri:server': esri_layer_version,
+                  'cartodb': cartodb_layer_version}
+
+# layer versions this process last saw, to know when its in-memory
+# results are stale
+_seen_versions = {}
+
+
+def detect_changes(provider, endpoint, force=False, strict=False):
+    '''
+    Poll a reference layer's metadata for edits and drop its cached tiles
+    if it changed. Layers are polled at most once per
+    SETTINGS['tile_cache']['check_interval'] seconds across all workers,
+    unless force is True. A failed poll is retried next interval, or
+    raised if strict is True. Returns True if the layer's tiles were
+    dropped
+    '''
+    cache = get_tile_cache()
+    if cache is None or provider not in LAYER_VERSIONS:
+        return False
+    layer = cache_layer(provider, endpoint)
+
+    changed = False
+    version, checked = cache.layer_state(layer)
+    if (force or time.time() - checked >=
+            SETTINGS['tile_cache']['check_interval']):
+        try:
+            latest = LAYER_VERSIONS[provider](endpoint)
+        except Exception:
+            if strict:
+                raise
+            # keep serving cached tiles and poll again next interval
+            latest = None
+        changed = cache.set_layer_version(layer, provider, endpoint, latest)
+        version = cache.layer_state(layer)[0]
+
+    # another worker may have seen the change first
+    if _seen_versions.get(layer, version) != version:
+        esri_server2ogr.cache_clear()
+        cartodb2ogr.cache_clear()
+    _seen_versions[layer] = version
+    return changed
+
+
+def refresh_layers():
+    '''
+    Poll every layer in the tile cache for edits now. Returns a dict of
+    layer endpoints to whether their tiles were dropped, or to the error
+    raised polling them
+    '''
+    cache = get_tile_cache()
+    if cache is None:
+        return {}
+    results = {}
+    for _, provider, endpoint in cache.layers():
+        try:
+            results[endpoint] = detect_changes(provider, endpoint,
+                                               force=True, strict=True)
+        except Exception as e:
+            results[endpoint] = e
+    return results
+
+
+_pool = None
+_pool_pid = None
+
+
+def get_pool():
+    '''
+    Process pool for geometry work, created once per worker process. Its
+    processes are spawned rather than forked, since the request threads may
+    be holding locks, sessions or sqlite handles at the time
+    '''
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ProcessPoolExecutor(
+            SETTINGS['dissolve']['workers'],
+            mp_context=multiprocessing.get_context('spawn'))
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def _union_all(geoms, grid_size=None):
+    return shapely.union_all(geoms, grid_size=grid_size)
+
+
+def spatial_partitions(geoms, partition_size):
+    '''
+    Split geometry indices into groups of about partition_size geometries
+    that are close together, by bucketing their centres into a grid. Groups
+    are ordered so that neighbouring groups are next to each other.
+    Missing and empty geometries have no position and are left out
+    '''
+    located = np.flatnonzero(~shapely.is_missing(geoms) &
+                             ~shapely.is_empty(geoms))
+    if not len(located):
+        return []
+    bounds = shapely.bounds(geoms[located])
+    x = (bounds[:, 0] + bounds[:, 2]) / 2
+    y = (bounds[:, 1] + bounds[:, 3]) / 2
+
+    cells = int(np.ceil(np.sqrt(len(located) / float(partition_size))))
+    col = np.minimum(((x - x.min()) / ((x.max() - x.min()) or 1) *
+                      cells).astype(int), cells - 1)
+    row = np.minimum(((y - y.min()) / ((y.max() - y.min()) or 1) *
+                      cells).astype(int), cells - 1)
+
+    # snake through the rows so consecutive cells always touch
+    col = np.where(row % 2, cells - 1 - col, col)
+    cell = row * cells + col
+
+    order = np.argsort(cell, kind='stable')
+    starts = np.flatnonzero(np.diff(cell[order])) + 1
+    return np.split(located[order], starts)
+
+
+def union_partitioned(geoms, grid_size=None):
+    '''
+    Union a large geometry array by unioning spatial partitions in a
+    process pool, then merging neighbouring partial unions pairwise until
+    one geometry is left
+    '''
+    partition_size = SETTINGS['dissolve']['partition_size']
+    workers = SETTINGS['dissolve']['workers']
+    if workers < 2 or len(geoms) <= partition_size:
+        return shapely.union_all(geoms, grid_size=grid_size)
+
+    pool = get_pool()
+    union = partial(_union_all, grid_size=grid_size)
+    partials = list(pool.map(union, [
+        geoms[partition]
+        for partition in spatial_partitions(geoms, partition_size)]))
+    while len(partials) > 1:
+        partials = list(pool.map(union, [
+            partials[i:i + 2] for i in range(0, len(partials), 2)]))
+    return partials[0]
+
+
+def union_coverage(geoms, grid_size=None):
+    '''
+    Union polygons that form a coverage (no overlaps, shared edges noded
+    identically) by merging their shared edges, which is much cheaper than
+    a full overlay. Falls back to a regular union if they are not a coverage
+    '''
+    polygonal = np.isin(shapely.get_type_id(geoms), [3, 6])
+    if polygonal.all() and shapely.coverage_is_valid(geoms):
+        return shapely.coverage_union_all(geoms)
+    return shapely.union_all(geoms, grid_size=grid_size)
+
+
+def dissolve(featureset, field=None, mode=None, extent=None):
     '''
     Dissolve a set of geometries on a field, or dissolve fully to a single
-    feature if no field is provided
+    feature if no field is provided.
+
+    With mode 'partitioned' each union is split into spatial partitions
+    unioned in a process pool, for large reference layers. With mode
+    'coverage', for layers of non-overlapping polygons, shared edges are
+    merged instead. If an extent featureset is given, features are first
+    clipped to its bounding box. Gridded featuresets are unioned on their
+    precision grid
     '''
+    featureset = repair(featureset)
+
+    if extent is not None and len(featureset):
+        xmin, ymin, xmax, ymax = shapely.total_bounds(
+            align_frame(as_featureset(extent), featureset).geometry)
+        grid_size = featureset.grid_size
+        if grid_size:
+            # cut on the grid, so the pieces stay on it
+            geoms = shapely.intersection(
+                featureset.geometry, shapely.box(xmin, ymin, xmax, ymax),
+                grid_size=grid_size)
+        else:
+            geoms = shapely.clip_by_rect(featureset.geometry,
+                                         xmin, ymin, xmax, ymax)
+        featureset = featureset.with_geometry(
+            geoms, valid=bool(grid_size), grid_size=grid_size).take(
+            np.flatnonzero(~shapely.is_empty(geoms)))
+        featureset = repair(featureset)
+
+    if len(featureset) == 0:
+        return FeatureSet(crs=featureset.crs, type=featureset.type)
+
+    grid_size = featureset.grid_size
+    if mode == 'partitioned':
+        union = partial(union_partitioned, grid_size=grid_size)
+    elif mode == 'coverage':
+        union = partial(union_coverage, grid_size=grid_size)
+    else:
+        def union(geoms):
+            return shapely.union_all(geoms, grid_size=grid_size)
 
     if field:
-        def sort_func(k):
-            return k['properties'][field]
-    else:
-        sort_func = None
+        # group feature indices by field value, keeping the first feature of
+        # each group for its properties
+        groups = {}
+        for i, value in enumerate(featureset.properties[field].tolist()):
+            groups.setdefault(value, []).append(i)
+        keys = sorted(groups.keys())
+        geoms = [union(featureset.geometry[groups[key]]) for key in keys]
+        first = [groups[key][0] for key in keys]
+        return featureset.take(first).with_geometry(geoms, valid=True,
+                                                    grid_size=grid_size)
+
+    # the merged features may disagree on every property, so none are kept
+    return FeatureSet([union(featureset.geometry)],
+                      crs=featureset.crs, type=featureset.type, valid=True,
+                      grid_size=grid_size)
+
+
+def query_intersecting(geoms, tree_geoms):
+    '''
+    Find every intersecting pair between two geometry arrays with a single
+    bulk STRtree query. Returns an array of indices into geoms and the
+    matching array of indices into tree_geoms, ordered by geoms index
+    '''
+    shapely.prepare(geoms)
+    tree = STRtree(tree_geoms)
+    idx, tree_idx = tree.query(geoms, predicate='intersects')
+    order = np.lexsort((tree_idx, idx))
+    return idx[order], tree_idx[order]
 
-    new_features = []
 
-    if len(featureset['features']) > 0:
-        if sort_func:
-            features = sorted(featureset['features'], key=sort_func)
-            for key, group in itertools.groupby(features, key=sort_func):
-                properties, geoms = zip(*[(f['properties'],
-                                          f['geometry']) for f in group])
-                new_features.append(dict(type='Feature',
-                                         geometry=unary_union(geoms),
-                                         properties=properties[0]))
+def subdivide(geoms, max_vertices):
+    '''
+    Cut every geometry with more than max_vertices vertices into quadtree
+    cells until each piece is under the budget, so overlays work on many
+    small polygons instead of one huge one. Returns the pieces and, for
+    each piece, the index of the geometry it came from
+    '''
+    max_vertices = int(max_vertices)
+    pieces = geoms
+    parent = np.arange(len(geoms))
+    done_pieces = []
+    done_parent = []
+
+    for _ in range(SUBDIVIDE_MAX_DEPTH):
+        large = shapely.get_num_coordinates(pieces) > max_vertices
+        done_pieces.append(pieces[~large])
+        done_parent.append(parent[~large])
+        pieces = pieces[large]
+        parent = parent[large]
+        if not len(pieces):
+            break
 
-        else:
-            geoms = [f['geometry'] for f in featureset['features']]
-            properties = {}  # TODO: decide which attributes should go in here
-            new_features.append(dict(type='Feature',
-                                     geometry=unary_union(geoms),
-                                     properties=properties))
-
-    new_featureset = dict(type=featureset['type'],
-                          features=new_features)
-    if 'crs' in featureset.keys():
-        new_featureset['crs'] = featureset['crs']
-    return new_featureset
+        xmin, ymin, xmax, ymax = shapely.bounds(pieces).T
+        xmid = (xmin + xmax) / 2
+        ymid = (ymin + ymax) / 2
+        quadrants = [(xmin, ymin, xmid, ymid), (xmid, ymin, xmax, ymid),
+                     (xmin, ymid, xmid, ymax), (xmid, ymid, xmax, ymax)]
+        pieces = np.concatenate([shapely.intersection(pieces,
+                                                      shapely.box(*quad))
+                                 for quad in quadrants])
+        parent = np.tile(parent, 4)
+
+        # drop slivers that only touch a cell edge
+        keep = shapely.area(pieces) > 0
+        pieces = pieces[keep]
+        parent = parent[keep]
+
+    done_pieces.append(pieces)
+    done_parent.append(parent)
+    return np.concatenate(done_pieces), np.concatenate(done_parent)
 
 
-def index_featureset(featureset):
+def merge_pieces(geoms, *keys, grid_size=None):
     '''
+    Union together the geometries that share the same values in every key
+    array, on the precision grid passed as grid_size if any. Returns the
+    distinct key arrays, sorted, and the merged geometries
     '''
-    index = rtree.index.Index()
-    for i, f in enumerate(featureset['features']):
-        geom = f['geometry']
-        if isinstance(geom, GeometryCollection):
-            minx = np.min([item.bounds[0] for item in geom])
-            miny = np.min([item.bounds[1] for item in geom])
-            maxx = np.max([item.bounds[2] for item in geom])
-            maxy = np.max([item.bounds[3] for item in geom])
-            index.insert(i, (minx, miny, maxx, maxy))
+    order = np.lexsort(keys[::-1])
+    geoms = geoms[order]
+    keys = [key[order] for key in keys]
+
+    starts = np.zeros(len(geoms), dtype=bool)
+    starts[:1] = True
+    for key in keys:
+        starts[1:] |= key[1:] != key[:-1]
+    starts = np.flatnonzero(starts)
+    ends = np.append(starts[1:], len(geoms))
+
+    merged = np.empty(len(starts), dtype=object)
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        merged[i] = (geoms[start] if end - start == 1 else
+                     shapely.union_all(geoms[start:end],
+                                       grid_size=grid_size))
+    return [key[starts] for key in keys], merged
+
+
+def overlay_pieces(geoms, max_vertices=None):
+    '''
+    Geometries to run an overlay on and the index of the input geometry
+    each one belongs to. Inputs are subdivided when a vertex budget is set
+    by argument or in SETTINGS['overlay']
+    '''
+    max_vertices = int(max_vertices or SETTINGS['overlay']['max_vertices'])
+    if max_vertices > 0:
+        return subdivide(geoms, max_vertices)
+    return geoms, None
+
+
+def repair(featureset):
+    '''
+    Make every invalid geometry valid, once, and flag the featureset as
+    valid so later overlays skip their validity checks. Uses GEOS make-valid
+    with the structure method, which keeps polygonal output polygonal
+    '''
+    featureset = as_featureset(featureset)
+    if featureset.valid:
+        return featureset
+
+    geoms = featureset.geometry
+    invalid = ~shapely.is_valid(geoms)
+    if invalid.any():
+        geoms = geoms.copy()
+        geoms[invalid] = shapely.make_valid(geoms[invalid],
+                                            method='structure',
+                                            keep_collapsed=False)
+    return featureset.with_geometry(geoms, valid=True)
+
+
+def intersect(featureset1, featureset2, max_vertices=None):
+    '''
+    Intersect every feature of featureset1 with every feature of
+    featureset2 it overlaps, merging their properties. Features of
+    featureset1 over max_vertices vertices are overlaid as quadtree pieces
+    and merged back afterwards
+    '''
+    featureset1 = repair(featureset1)
+    featureset2 = align_frame(repair(featureset2), featureset1)
+
+    grid_size = overlay_grid(featureset1, featureset2)
+
+    geoms1, parent = overlay_pieces(featureset1.geometry, max_vertices)
+    geoms2 = featureset2.geometry
+
+    idx1, idx2 = query_intersecting(geoms1, geoms2)
+    new_geoms = shapely.intersection(geoms1[idx1], geoms2[idx2],
+                                     grid_size=grid_size)
+    if parent is not None:
+        (idx1, idx2), new_geoms = merge_pieces(new_geoms, parent[idx1], idx2,
+                                               grid_size=grid_size)
+
+    properties = merge_properties(featureset2.take(idx2).properties,
+                                  featureset1.take(idx1).properties)
+    return FeatureSet(new_geoms, properties, crs=featureset2.crs,
+                      type=featureset2.type, valid=True, grid_size=grid_size)
+
+
+def split_features(featureset, split_featureset, inside=True, outside=True,
+                   max_vertices=None):
+    '''
+    Cut featureset by split_featureset from a single index query. Returns
+    the intersect-style pieces inside split_featureset (one per overlapping
+    pair) and the pieces outside it (one per input feature, with the union
+    of all overlapping split geometries subtracted once, and an empty
+    geometry if nothing is left). A part that is not requested is returned
+    as None
+    '''
+    featureset = repair(featureset)
+    split_featureset = align_frame(repair(split_featureset), featureset)
+
+    grid_size = overlay_grid(featureset, split_featureset)
+
+    geoms = featureset.geometry
+    pieces, parent = overlay_pieces(geoms, max_vertices)
+    split_geoms = split_featureset.geometry
+
+    idx, split_idx = query_intersecting(pieces, split_geoms)
+
+    inside_featureset = None
+    if inside:
+        new_geoms = shapely.intersection(pieces[idx], split_geoms[split_idx],
+                                         grid_size=grid_size)
+        pair_idx, pair_split_idx = idx, split_idx
+        if parent is not None:
+            (pair_idx, pair_split_idx), new_geoms = merge_pieces(
+                new_geoms, parent[idx], split_idx, grid_size=grid_size)
+        properties = merge_properties(
+            split_featureset.take(pair_split_idx).properties,
+            featureset.take(pair_idx).properties)
+        inside_featureset = FeatureSet(
+            new_geoms, properties, crs=split_featureset.crs,
+            type=split_featureset.type, valid=True, grid_size=grid_size)
+
+    outside_featureset = None
+    if outside:
+        overlapped, starts = np.unique(idx, return_index=True)
+        overlaps = [shapely.union_all(split_geoms[group],
+                                      grid_size=grid_size)
+                    for group in np.split(split_idx, starts[1:])]
+        new_pieces = pieces.copy()
+        if len(overlapped):
+            new_pieces[overlapped] = shapely.difference(
+                pieces[overlapped], overlaps, grid_size=grid_size)
+        if parent is None:
+            new_geoms = new_pieces
         else:
-            index.insert(i, geom.bounds)
-    return index
+            new_geoms = geoms.copy()
+            cut = np.isin(parent, parent[overlapped])
+            if cut.any():
+                (cut_idx,), merged = merge_pieces(
+                    new_pieces[cut], parent[cut], grid_size=grid_size)
+                new_geoms[cut_idx] = merged
+        # features erased completely keep an empty geometry
+        outside_featureset = featureset.with_geometry(
+            new_geoms, valid=True, grid_size=grid_size)
 
+    return inside_featureset, outside_featureset
 
-def intersect(featureset1, featureset2):
+
+def clip(featureset, clip_featureset):
     '''
+    Cut every feature of featureset down to the area it shares with
+    clip_featureset, keeping its own properties and dropping features that
+    do not overlap. Clipping reference data to the AOI before dissolving it
+    gives the same overlay results for much less union work
     '''
+    featureset = repair(featureset)
+    clip_featureset = align_frame(repair(clip_featureset), featureset)
 
-    index = index_featureset(featureset2)
+    grid_size = overlay_grid(featureset, clip_featureset)
 
-    new_features = []
+    clip_geoms = clip_featureset.geometry
+    idx, clip_idx = query_intersecting(featureset.geometry, clip_geoms)
 
-    for f in featureset1['features']:
-        feat1 = f
-        geom1 = f['geometry']
-        for fid in list(index.intersection(geom1.bounds)):
-            feat2 = featureset2['features'][fid]
-            geom2 = feat2['geometry']
-            if not geom1.is_valid:
-                # raise ValueError('Geometry from featureset1 is not valid')
-                geom1 = geom1.buffer(0)
-            if not geom2.is_valid:
-                # raise ValueError('Geometry from featureset2 is not valid')
-                geom2 = geom2.buffer(0)
+    clipped, starts = np.unique(idx, return_index=True)
+    masks = [shapely.union_all(clip_geoms[group], grid_size=grid_size)
+             for group in np.split(clip_idx, starts[1:])]
+    geoms = shapely.intersection(featureset.geometry[clipped], masks,
+                                 grid_size=grid_size)
 
-            if geom1.intersects(geom2):  # TODO: optimize to on intersect call?
-                new_geom = geom1.intersection(geom2)
-                new_feat = dict(properties={**feat2['properties'],
-                                            **feat1['properties']},
-                                geometry=new_geom,
-                                type='Feature')
-                new_features.append(new_feat)
+    # drop features that only touch the clip features
+    keep = shapely.area(geoms) > 0
+    return featureset.take(clipped[keep]).with_geometry(
+        geoms[keep], valid=True, grid_size=grid_size)
 
-    new_featureset = dict(type=featureset2['type'],
-                          features=new_features)
-    if 'crs' in featureset2.keys():
-        new_featureset['crs'] = featureset2['crs']
 
-    return new_featureset
+def simplify(featureset, extent, accuracy):
+    '''
+    Simplify reference geometries as far as the analysis allows. accuracy
+    is the largest acceptable change in area, as a fraction of the area of
+    the extent featureset (usually the AOI).
+
+    Simplification is topology preserving Douglas-Peucker, which keeps
+    every removed stretch of boundary within the tolerance of the segment
+    that replaces it, so the area change of a feature is at most
+    2 * tolerance * perimeter plus pi * tolerance ** 2 for the round cap at
+    each segment end. The tolerance is picked so the bound summed over all
+    features, caps included, stays within accuracy, and each feature's
+    bound is recorded as a fraction of the extent area in an area_error
+    property.
+
+    Features are simplified one at a time, so edges shared between features
+    can drift apart; simplify dissolved data, whose features share none
+    '''
+    featureset = repair(featureset)
+    extent = align_frame(repair(extent), featureset)
+    accuracy = float(accuracy)
+
+    def unsimplified():
+        simplified = featureset.take(np.arange(len(featureset)))
+        simplified.properties['area_error'] = np.zeros(len(featureset))
+        return simplified
+
+    extent_area = shapely.area(shapely.union_all(extent.geometry))
+    perimeter = shapely.length(featureset.geometry).sum()
+    if not len(featureset) or not extent_area or not perimeter:
+        return unsimplified()
+
+    # simplifying never lengthens a boundary or adds segments, so solving
+    # 2 * t * perimeter + pi * t ** 2 * segments = budget for the input
+    # features bounds the simplified ones too
+    budget = accuracy * extent_area
+    segments = segment_counts(featureset.geometry).sum()
+    tolerance = budget / (perimeter + np.sqrt(
+        perimeter ** 2 + np.pi * segments * budget))
+    geoms = shapely.simplify(featureset.geometry, tolerance,
+                             preserve_topology=True)
+
+    error = (2 * tolerance * shapely.length(geoms) +
+             np.pi * tolerance ** 2 * segment_counts(geoms)) / extent_area
+    # rounding can still push the bound over accuracy
+    if error.sum() > accuracy:
+        return unsimplified()
+
+    simplified = featureset.with_geometry(geoms, valid=True,
+                                          grid_size=featureset.grid_size)
+    simplified.properties['area_error'] = error
+    return simplified
+
+
+def segment_counts(geoms):
+    '''
+    Number of segments in each geometry: every ring or line has one fewer
+    than it has coordinates
+    '''
+    parts, part_index = shapely.get_parts(geoms, return_index=True)
+    return shapely.get_num_coordinates(geoms) - np.bincount(
+        part_index, weights=1 + shapely.get_num_interior_rings(parts),
+        minlength=len(geoms))
+
+
+def simplify_error(featureset):
+    '''
+    Upper bound on the area change caused by simplify, as a fraction of the
+    extent area it was simplified for
+    '''
+    featureset = as_featureset(featureset)
+    if 'area_error' not in featureset.properties:
+        return 0.0
+    return float(np.sum(featureset.properties['area_error']))
 
 
-def erase(featureset, erase_featureset):
+def erase(featureset, erase_featureset, max_vertices=None):
     '''
+    Remove the area covered by erase_featureset from every feature of
+    featureset. There is one result per input feature, and a feature that
+    is erased completely keeps its properties with an empty geometry
     '''
+    return split_features(featureset, erase_featureset, inside=False,
+                          max_vertices=max_vertices)[1]
 
-    index = index_featureset(erase_featureset)
 
-    new_features = []
+def split(featureset, split_featureset, max_vertices=None):
+    '''
+    Compute intersect and erase results together. Returns one featureset
+    whose split property is "inside" for intersect pieces and "outside"
+    for erase pieces; use select to pull either part out of a graph
+    '''
+    inside, outside = split_features(featureset, split_featureset,
+                                     max_vertices=max_vertices)
+    inside.properties['split'] = np.full(len(inside), 'inside')
+    outside.properties['split'] = np.full(len(outside), 'outside')
+    return FeatureSet.concat([inside, outside])
 
-    for f in featureset['features']:
-        feat = f
-        geom = f['geometry']
-        for fid in list(index.intersection(geom.bounds)):
-            erase_feat = erase_featureset['features'][fid]
-            erase_geom = erase_feat['geometry']
-            if geom.intersects(erase_geom):
-                new_geom = geom.difference(erase_geom)
-                new_feat = dict(properties={**feat['properties']},
-                                geometry=new_geom,
-                                type='Feature')
-                new_features.append(new_feat)
 
-    new_featureset = dict(type=featureset['type'],
-                          features=new_features)
-    if 'crs' in featureset.keys():
-        new_featureset['crs'] = featureset['crs']
+def select(featureset, field, value):
+    '''
+    Select the features whose field matches value, dropping the field
+    '''
+    featureset = as_featureset(featureset)
+    values = (featureset.properties[field].tolist() if len(featureset)
+              else [])
+    selected = featureset.take([i for i, v in enumerate(values)
+                                if str(v) == str(value)])
+    del selected.properties[field]
+    return selected
 
-    return new_featureset
 
+def project_geometries(geoms, transformer):
+    '''
+    Transform every coordinate of a geometry array with a single call to a
+    pyproj transformer. Returns new geometries, the input is not modified
+    '''
+    def project(coords):
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack([x, y])
 
-def project_features(featureset, project):
-    new_features = []
-    for f in featureset['features']:
-        if isinstance(f['geometry'], Polygon):
-            geom = Polygon(f['geometry'])
-        elif isinstance(f['geometry'], MultiPolygon):
-            geom = MultiPolygon(f['geometry'])
-        elif isinstance(f['geometry'], GeometryCollection):
-            geom = GeometryCollection(f['geometry'])
+    return shapely.transform(geoms, project)
 
-        projected_geom = transform(project, geom)
-        new_feat = dict(properties=f['properties'],
-                        geometry=projected_geom,
-                        type='Feature')
-        new_features.append(new_feat)
 
-    return dict(type=featureset['type'],
-                features=new_features)
+def project_features(featureset, transformer):
+    new_geoms = project_geometries(featureset.geometry, transformer)
 
+    # a smooth reprojection keeps valid geometries valid
+    return FeatureSet(new_geoms, featureset.properties, type=featureset.type,
+                      valid=featureset.valid)
 
-def project_local(featureset):
-    if ('crs' in featureset.keys() and
-            featureset['crs']['properties']['name'] ==
-            'urn:ogc:def:uom:EPSG::9102'):
-        return featureset
 
-    name = 'urn:ogc:def:uom:EPSG::9102'
+def is_projected(featureset):
+    '''
+    Check whether a featureset is in a local azimuthal equidistant frame
+    '''
+    return bool(featureset.crs and
+                featureset.crs['properties']['name'] ==
+                'urn:ogc:def:uom:EPSG::9102')
 
-    # get cumulative centroid of all features
-    x, y = 0, 0
-    for f in featureset['features']:
-        if isinstance(f['geometry'], GeometryCollection):
-            x += np.mean([geom_item.centroid.x for geom_item in f['geometry']])
-            y += np.mean([geom_item.centroid.y for geom_item in f['geometry']])
-        else:
-            x += f['geometry'].centroid.x
-            y += f['geometry'].centroid.y
-    x = x / len(featureset['features']) if featureset['features'] else 0
-    y = y / len(featureset['features']) if featureset['features'] else 0
 
-    # define local projection
-    proj4 = '+proj=aeqd +lat_0={} +lon_0={} +x_0=0 +y_0=0 +datum=WGS84 \
+def get_centroid(featureset):
+    '''
+    Cumulative centroid of all features
+    '''
+    if not len(featureset):
+        return 0, 0
+
+    centroids = shapely.centroid(featureset.geometry)
+    x, y = shapely.get_x(centroids), shapely.get_y(centroids)
+
+    # collections use the mean centroid of their members
+    for i, geom in enumerate(featureset.geometry):
+        if isinstance(geom, GeometryCollection):
+            x[i] = np.mean([geom_item.centroid.x for geom_item in geom.geoms])
+            y[i] = np.mean([geom_item.centroid.y for geom_item in geom.geoms])
+
+    return float(x.mean()), float(y.mean())
+
+
+def local_proj4(x, y):
+    '''
+    Azimuthal equidistant projection centred on a point
+    '''
+    return '+proj=aeqd +lat_0={} +lon_0={} +x_0=0 +y_0=0 +datum=WGS84 \
              +units=m +no_defs +R=6371000 '.format(y, x)
 
-    # define projection transformation
-    project = partial(pyproj.transform,
-                      pyproj.Proj(init='epsg:4326'),
-                      pyproj.Proj(proj4))
 
-    # peoject features and add projection info
-    new_featureset = project_features(featureset, project)
-    new_featureset['crs'] = dict(type="name",
-                                 properties=dict(name=name,
-                                                 centroid=[x, y]))
+@lru_cache(64)
+def get_transformer(source=None, target=None):
+    '''
+    Cached transformer between two frames, each either None for EPSG:4326
+    or the (x, y) centre of a local projection
+    '''
+    def crs(frame):
+        return ('EPSG:4326' if frame is None else
+                pyproj.CRS.from_proj4(local_proj4(*frame)))
+
+    return pyproj.Transformer.from_crs(crs(source), crs(target),
+                                       always_xy=True)
+
+
+def get_frame(featureset):
+    '''
+    Centre of the local projection a featureset is in, or None if it is
+    not projected
+    '''
+    if is_projected(featureset):
+        return tuple(featureset.crs['properties']['centroid'])
+    return None
+
+
+def projection_frame(featureset):
+    '''
+    Local projection crs centred on a featureset. Create it once per graph
+    from the AOI and pass it to every project_local node so that all
+    projected featuresets share one frame
+    '''
+    featureset = as_featureset(featureset)
+    if is_projected(featureset):
+        return featureset.crs
+
+    x, y = get_centroid(featureset)
+    return dict(type="name",
+                properties=dict(name='urn:ogc:def:uom:EPSG::9102',
+                                centroid=[x, y]))
+
+
+def project_to_frame(featureset, crs):
+    '''
+    Project a featureset into the frame of a crs block, doing nothing if
+    it is already there
+    '''
+    source = get_frame(featureset)
+    target = (tuple(crs['properties']['centroid'])
+              if crs['properties']['name'] == 'urn:ogc:def:uom:EPSG::9102'
+              else None)
+    if source == target:
+        return featureset
+
+    new_featureset = project_features(featureset,
+                                      get_transformer(source, target))
+    new_featureset.crs = crs
     return new_featureset
 
 
+def align_frame(featureset, other):
+    '''
+    Bring featureset into the frame of other before overlaying them
+    '''
+    if get_frame(featureset) == get_frame(other):
+        return featureset
+    if other.crs is None:
+        return project_global(featureset)
+    return project_to_frame(featureset, other.crs)
+
+
+def project_local(featureset, frame=None):
+    '''
+    Project a featureset into a local azimuthal equidistant frame, either
+    the shared frame from projection_frame or one centred on the featureset
+    '''
+    featureset = as_featureset(featureset)
+    if frame is None:
+        if is_projected(featureset):
+            return featureset
+        frame = projection_frame(featureset)
+
+    return project_to_frame(featureset, frame)
+
+
 def project_global(featureset):
-    if ('crs' in featureset.keys() and
-            featureset['crs']['properties']['name'] == 'EPSG:4326'):
+    featureset = as_featureset(featureset)
+    if featureset.crs and not is_projected(featureset):
         return featureset
-    elif 'crs' not in featureset.keys():
+    elif not featureset.crs:
         raise ValueError('Local projection must have crs info to reproject')
 
-    name = 'EPSG:4326'
-    [x, y] = featureset['crs']['properties']['centroid']
+    return project_to_frame(featureset,
+                            dict(type="name",
+                                 properties=dict(name='EPSG:4326')))
 
-    proj4 = '+proj=aeqd +lat_0={} +lon_0={} +x_0=0 +y_0=0 +datum=WGS84 \
-             +units=m +no_defs +R=6371000 '.format(y, x)
 
-    project = partial(pyproj.transform,
-                      pyproj.Proj(proj4),
-                      pyproj.Proj(init='epsg:4326'))
+def buffer_to_dist(featureset, distance, quad_segs=None):
+    '''
+    Buffer a geometry with a given distance (assumed to be kilometers),
+    approximating quarter circles with quad_segs segments
+    '''
+    featureset = as_featureset(featureset)
+    if not is_projected(featureset):
+        raise ValueError('geometries must be projected with the World ' +
+                         'Azimuthal Equidistant coordinate system')
 
-    new_featureset = project_features(featureset, project)
-    new_featureset['crs'] = dict(type="name",
-                                 properties=dict(name=name))
-    return new_featureset
+    kwargs = dict(quad_segs=int(quad_segs)) if quad_segs else {}
+    new_geoms = shapely.buffer(featureset.geometry,
+                               int(distance) * 1000.0, **kwargs)
 
+    return featureset.with_geometry(new_geoms, valid=True)
 
-def buffer_to_dist(featureset, distance):
+
+def buffer_rings(featureset, distances, quad_segs=None):
     '''
-    Buffer a geometry with a given distance (assumed to be kilometers)
+    Buffer every feature to each of a comma-separated list of distances in
+    kilometers, returning one featureset whose buffer_km property holds the
+    distance as given; use select to pull out a single distance.
+
+    Every distance is buffered from the original geometries in one
+    vectorized call, so each buffer is the one buffer_to_dist would return
     '''
-    if not (featureset['crs']['properties']['name'] ==
-            'urn:ogc:def:uom:EPSG::9102'):
+    featureset = as_featureset(featureset)
+    if not is_projected(featureset):
         raise ValueError('geometries must be projected with the World ' +
                          'Azimuthal Equidistant coordinate system')
 
-    new_features = []
+    distances = sorted([d.strip() for d in distances.split(',') if d.strip()],
+                       key=float)
+    kwargs = dict(quad_segs=int(quad_segs)) if quad_segs else {}
 
-    for f in featureset['features']:
-        geom = f['geometry']
-        buffered_geom = geom.buffer(int(distance) * 1000.0)
-        new_feat = dict(properties=f['properties'],
-                        geometry=buffered_geom,
-                        type='Feature')
-        new_features.append(new_feat)
+    # every feature once per distance, smallest distance first
+    rings = featureset.take(np.tile(np.arange(len(featureset)),
+                                    len(distances)))
+    buffer_km = np.repeat(distances, len(featureset))
+    geoms = shapely.buffer(rings.geometry,
+                           buffer_km.astype(float) * 1000.0, **kwargs)
 
-    new_featureset = dict(type=featureset['type'],
-                          features=new_features)
-    if 'crs' in featureset.keys():
-        new_featureset['crs'] = featureset['crs']
-    return new_featureset
+    rings = rings.with_geometry(geoms, valid=True)
+    rings.properties['buffer_km'] = buffer_km
+    return rings
 
 
 # ------------------------- Calculation Functions --------------------------
@@ -540,64 +1411,132 @@ def validate_featureset(featureset, fields=[None]):
     '''
     valid_fields = [f for f in fields if f]
     for field in valid_fields:
-        for f in featureset['features']:
-            if field not in f['properties'].keys():
-                raise ValueError('Featureset with category field must ' +
-                                 'have category field as a property of ' +
-                                 'every feature')
+        if len(featureset) and not featureset.has_property(field):
+            raise ValueError('Featureset with category field must ' +
+                             'have category field as a property of ' +
+                             'every feature')
     if len(valid_fields) == 0:
-        if len(featureset['features']) > 1:
+        if len(featureset) > 1:
             raise ValueError('Featureset with multiple features must ' +
                              'be dissolved or have a category field in ' +
                              'order to calculate statistics')
 
 
-def get_area(featureset, field=None):
-    validate_featureset(featureset, [field])
-
+def geodesic_area(geoms):
+    '''
+    Area in square metres of EPSG:4326 polygonal geometries on the WGS84
+    ellipsoid. Every ring is measured at once with the shoelace formula in
+    the ellipsoid's cylindrical equal-area coordinates, so there is no
+    reprojection and no per-geometry python call. Edges are taken as
+    straight lines in longitude/latitude, as in GeoJSON
+    '''
+    parts, part_idx = shapely.get_parts(geoms, return_index=True)
+    is_polygon = shapely.get_type_id(parts) == 3
+    parts, part_idx = parts[is_polygon], part_idx[is_polygon]
+    rings, ring_idx = shapely.get_rings(parts, return_index=True)
+
+    coords, coord_idx = shapely.get_coordinates(rings, return_index=True)
+    if not len(coords):
+        return np.zeros(len(geoms))
+
+    # authalic y coordinate: y = a^2 * q(lat) / 2
+    e = np.sqrt(WGS84_E2)
+    x = np.radians(coords[:, 0])
+    sin_lat = np.sin(np.radians(coords[:, 1]))
+    q = (1 - WGS84_E2) * (sin_lat / (1 - WGS84_E2 * sin_lat ** 2) -
+                          np.log((1 - e * sin_lat) / (1 + e * sin_lat)) /
+                          (2 * e))
+    y = WGS84_A ** 2 * q / 2
+
+    # trapezoids between consecutive vertices of the same (closed) ring
+    same_ring = coord_idx[1:] == coord_idx[:-1]
+    trapezoids = (x[1:] - x[:-1]) * (y[1:] + y[:-1]) / 2
+    ring_area = np.abs(np.bincount(coord_idx[1:][same_ring],
+                                   weights=trapezoids[same_ring],
+                                   minlength=len(rings)))
+
+    # the first ring of each polygon is its shell, the rest are holes
+    sign = -np.ones(len(rings))
+    sign[np.unique(ring_idx, return_index=True)[1]] = 1
+    polygon_area = np.bincount(ring_idx, weights=sign * ring_area,
+                               minlength=len(parts))
+
+    return np.bincount(part_idx, weights=polygon_area, minlength=len(geoms))
+
+
+def area_by_field(featureset, areas, field=None):
+    '''
+    Convert per-feature areas in square metres to hectares, keyed by field
+    value, or the first feature's area if there is no field
+    '''
     if field:
         area = {}
-        for f in featureset['features']:
-            area[f['properties'][field]] = f['geometry'].area / HA_CONVERSION
+        for value, feature_area in zip(featureset.properties[field].tolist()
+                                       if len(featureset) else [], areas):
+            area[value] = float(feature_area) / HA_CONVERSION
     else:
-        if featureset['features']:
-            area = featureset['features'][0]['geometry'].area / HA_CONVERSION
+        if len(featureset):
+            area = float(areas[0]) / HA_CONVERSION
         else:
             area = 0
     return area
 
 
+def get_area(featureset, field=None):
+    featureset = as_featureset(featureset)
+    validate_featureset(featureset, [field])
+
+    return area_by_field(featureset, shapely.area(featureset.geometry), field)
+
+
+def get_geodesic_area(featureset, field=None):
+    '''
+    Area of an EPSG:4326 featureset measured on the ellipsoid, without
+    projecting it first. Use in place of project_local and get_area
+    '''
+    featureset = as_featureset(featureset)
+    if is_projected(featureset):
+        raise ValueError('geodesic area needs unprojected geometries')
+    validate_featureset(featureset, [field])
+
+    return area_by_field(featureset, geodesic_area(featureset.geometry),
+                         field)
+
+
 def get_area_percent(featureset, aoi_area, aoi_field=None, int_field=None):
+    featureset = as_featureset(featureset)
     validate_featureset(featureset, [int_field, aoi_field])
 
+    def column(field):
+        return (featureset.properties[field].tolist() if len(featureset)
+                else [])
+
     if aoi_field and int_field:
         area_pct = {}
+        aois = column(aoi_field)
+        int_categories = column(int_field)
         for aoi, area in aoi_area.items():
             area_pct[aoi] = {}
-            for f in [f for f in featureset['features'] if
-                      f['properties'][aoi_field] == aoi]:
-                int_category = f['properties'][int_field]
-                area_pct[aoi][int_category] = (f['geometry'].area /
-                                               HA_CONVERSION / area * 100)
+            for i in [i for i, v in enumerate(aois) if v == aoi]:
+                area_pct[aoi][int_categories[i]] = (
+                    featureset.geometry[i].area / HA_CONVERSION / area * 100)
     elif aoi_field:
         area_pct = {}
-        for f in featureset['features']:
-            aoi = f['properties'][aoi_field]
+        for aoi, geom in zip(column(aoi_field), featureset.geometry):
             area = aoi_area[aoi]
-            area_pct[aoi] = (f['geometry'].area / HA_CONVERSION / area *
+            area_pct[aoi] = (geom.area / HA_CONVERSION / area *
                              100)
         for aoi in aoi_area.keys():
             if aoi not in area_pct.keys():
                 area_pct[aoi] = 0
     elif int_field:
         area_pct = {}
-        for f in featureset['features']:
-            int_category = f['properties'][int_field]
-            area_pct[int_category] = (f['geometry'].area / HA_CONVERSION /
+        for int_category, geom in zip(column(int_field), featureset.geometry):
+            area_pct[int_category] = (geom.area / HA_CONVERSION /
                                       aoi_area * 100)
     else:
-        if featureset['features']:
-            area_pct = (featureset['features'][0]['geometry'].area /
+        if len(featureset):
+            area_pct = (featureset.geometry[0].area /
                         HA_CONVERSION / aoi_area * 100)
         else:
             area_pct = 0
@@ -605,6 +1544,105 @@ def get_area_percent(featureset, aoi_area, aoi_field=None, int_field=None):
     return area_pct
 
 
+def intersect_area(featureset1, featureset2, aoi_field=None, int_field=None,
+                   method='planar', max_vertices=None):
+    '''
+    Area in hectares of the intersection of two featuresets, without
+    keeping the intersection geometries. Each intersection piece is measured
+    as soon as it is computed, in a local projection centred on featureset1
+    unless the inputs are already projected, or on the ellipsoid if method
+    is 'geodesic'.
+
+    Returns a single area, a dict of areas by aoi_field or int_field value,
+    or a dict by aoi_field value of dicts by int_field value. Areas of
+    pieces sharing the same values are summed. Without a field, each
+    featureset is dissolved first, so areas where its features overlap are
+    counted once
+    '''
+    featureset1 = repair(featureset1)
+    featureset2 = align_frame(repair(featureset2), featureset1)
+
+    if not aoi_field and not int_field:
+        if len(featureset1) > 1:
+            featureset1 = dissolve(featureset1)
+        if len(featureset2) > 1:
+            featureset2 = dissolve(featureset2)
+
+    grid_size = overlay_grid(featureset1, featureset2)
+
+    geoms1, parent = featureset1.geometry, None
+    # the vertices cell edges add along other edges only leave the area
+    # unchanged when it is measured in the plane the overlay runs in
+    if method != 'geodesic' and is_projected(featureset1):
+        geoms1, parent = overlay_pieces(geoms1, max_vertices)
+
+    idx1, idx2 = query_intersecting(geoms1, featureset2.geometry)
+    pieces = shapely.intersection(geoms1[idx1], featureset2.geometry[idx2],
+                                  grid_size=grid_size)
+    if parent is not None:
+        idx1 = parent[idx1]
+
+    if method == 'geodesic':
+        if is_projected(featureset1):
+            raise ValueError('geodesic area needs unprojected geometries')
+        areas = geodesic_area(pieces)
+    elif is_projected(featureset1):
+        areas = shapely.area(pieces)
+    else:
+        areas = shapely.area(project_geometries(
+            pieces, get_transformer(None, get_centroid(featureset1))))
+    del pieces
+    areas = np.asarray(areas, dtype=float) / HA_CONVERSION
+
+    if (aoi_field or int_field) and not len(areas):
+        return {}
+
+    properties = merge_properties(featureset2.take(idx2).properties,
+                                  featureset1.take(idx1).properties)
+
+    def column(field):
+        if field not in properties:
+            raise ValueError('Featureset with category field must ' +
+                             'have category field as a property of ' +
+                             'every feature')
+        return properties[field].tolist()
+
+    if aoi_field and int_field:
+        area = {}
+        for aoi, category, piece_area in zip(column(aoi_field),
+                                             column(int_field), areas):
+            area.setdefault(aoi, {})
+            area[aoi][category] = area[aoi].get(category, 0) + piece_area
+    elif aoi_field or int_field:
+        area = {}
+        for key, piece_area in zip(column(aoi_field or int_field), areas):
+            area[key] = area.get(key, 0) + piece_area
+    else:
+        area = float(areas.sum())
+
+    return area
+
+
+def get_area_percent_from_area(area, aoi_area):
+    '''
+    Percentage of aoi_area covered by area, where both come from get_area
+    or intersect_area. A dict of aoi areas is matched to the first level of
+    an area dict; a single aoi area divides every value
+    '''
+    if isinstance(area, dict):
+        area_pct = {}
+        for key, value in area.items():
+            total = aoi_area[key] if isinstance(aoi_area, dict) else aoi_area
+            area_pct[key] = get_area_percent_from_area(value, total)
+        if isinstance(aoi_area, dict):
+            for key in aoi_area.keys():
+                if key not in area_pct.keys():
+                    area_pct[key] = 0
+        return area_pct
+
+    return area / aoi_area * 100 if aoi_area else 0
+
+
 def get_histo_loss_area(histograms, forest_density=30):
     '''
     Returns the sum of tree cover loss for years 2001 through 2014
@@ -734,9 +1772,11 @@ def get_species_count(intersection, field):
     Count number of unique species found within the features of an
     intersection with the user AOI
     '''
+    intersection = as_featureset(intersection)
     species_list = []
-    for f in intersection['features']:
-        species_string = f['properties'][field][1:-1].replace('"', '')
+    for value in (intersection.properties[field].tolist()
+                  if len(intersection) else []):
+        species_string = value[1:-1].replace('"', '')
         species_list += species_string.split(',')
     species_set = set(species_list)
     return len(species_set)
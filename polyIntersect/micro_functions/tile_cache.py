@@ -0,0 +1,323 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import shapely
+
+from polyIntersect.config import SETTINGS
+from polyIntersect.micro_functions.featureset import FeatureSet, MISSING
+
+
+__all__ = ['TileCache', 'get_tile_cache', 'tiles_for', 'tile_bounds']
+
+SCHEMA_VERSION = 2
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tiles (
+    id INTEGER PRIMARY KEY,
+    layer TEXT NOT NULL,
+    where_clause TEXT NOT NULL,
+    fields TEXT NOT NULL,
+    tile TEXT NOT NULL,
+    accessed REAL NOT NULL,
+    UNIQUE (layer, where_clause, fields, tile)
+);
+CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed);
+CREATE TABLE IF NOT EXISTS features (
+    id INTEGER PRIMARY KEY,
+    layer TEXT NOT NULL,
+    where_clause TEXT NOT NULL,
+    fields TEXT NOT NULL,
+    key TEXT NOT NULL,
+    geometry BLOB,
+    properties TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    UNIQUE (layer, where_clause, fields, key)
+);
+CREATE INDEX IF NOT EXISTS features_layer ON features (layer);
+CREATE TABLE IF NOT EXISTS tile_features (
+    tile_id INTEGER NOT NULL,
+    feature_id INTEGER NOT NULL,
+    PRIMARY KEY (tile_id, feature_id)
+);
+CREATE INDEX IF NOT EXISTS tile_features_feature
+    ON tile_features (feature_id);
+CREATE TABLE IF NOT EXISTS layers (
+    layer TEXT PRIMARY KEY,
+    provider TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    version TEXT,
+    checked REAL NOT NULL
+);
+'''
+
+
+def tile_size(zoom):
+    return 360.0 / 2 ** zoom
+
+
+def tile_bounds(tile):
+    '''
+    (xmin, ymin, xmax, ymax) in degrees of a "zoom/x/y" tile id. Tiles are
+    square in longitude and latitude, counted from (-180, -90)
+    '''
+    zoom, x, y = (int(part) for part in tile.split('/'))
+    size = tile_size(zoom)
+    return (-180 + x * size, -90 + y * size,
+            -180 + (x + 1) * size, -90 + (y + 1) * size)
+
+
+def tiles_for(geoms, zoom):
+    '''
+    Ids of the tiles at a zoom level that intersect any of the geometries
+    '''
+    size = tile_size(zoom)
+    tiles = set()
+    for xmin, ymin, xmax, ymax in shapely.bounds(geoms):
+        if np.isnan(xmin):
+            continue
+        for x in range(int((xmin + 180) // size), int((xmax + 180) // size)
+                       + 1):
+            for y in range(int((ymin + 90) // size),
+                           int((ymax + 90) // size) + 1):
+                tiles.add('{}/{}/{}'.format(zoom, x, y))
+
+    tiles = sorted(tiles)
+    boxes = shapely.box(*np.array([tile_bounds(t) for t in tiles]).T) \
+        if tiles else np.empty(0, dtype=object)
+    hits = shapely.STRtree(geoms).query(boxes, predicate='intersects')[0]
+    return [tiles[i] for i in np.unique(hits)]
+
+
+def _load(rows):
+    '''
+    Featureset of (geometry, properties) rows as stored by TileCache.put
+    '''
+    records = [json.loads(properties) for _, properties in rows]
+    names = OrderedDict()
+    for record in records:
+        for name in record:
+            names[name] = None
+    columns = OrderedDict(
+        (name, [record.get(name, MISSING) for record in records])
+        for name in names)
+    return FeatureSet(shapely.from_wkb([geometry for geometry, _ in rows]),
+                      columns)
+
+
+def _ids(ids):
+    # ids come from the database, so they are always integers
+    return ','.join(str(int(i)) for i in ids)
+
+
+class TileCache(object):
+    '''
+    Reference features by layer, where clause and fields, kept in a sqlite
+    file that every worker process on the host shares. Each feature is
+    stored once, under the value of a property that identifies it, with an
+    index of the features in each cached tile. Least recently used tiles,
+    and the features no other tile holds, are evicted once the cache grows
+    past max_bytes
+    '''
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            version = self.db.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                # tiles cached in an older layout are dropped, not migrated
+                self.db.executescript(
+                    'DROP TABLE IF EXISTS tile_features; '
+                    'DROP TABLE IF EXISTS features; '
+                    'DROP TABLE IF EXISTS tiles;')
+                self.db.execute('PRAGMA user_version = {}'.format(
+                    SCHEMA_VERSION))
+            self.db.executescript(_SCHEMA)
+
+    def get(self, layer, where, fields, tiles):
+        '''
+        Ids of whichever of the tiles are in the cache, and a featureset of
+        the features in them, each feature once
+        '''
+        found = OrderedDict()
+        with self.lock, self.db:
+            for tile in tiles:
+                row = self.db.execute(
+                    'SELECT id FROM tiles WHERE layer = ? AND '
+                    'where_clause = ? AND fields = ? AND tile = ?',
+                    (layer, where, fields, tile)).fetchone()
+                if row is not None:
+                    found[tile] = row[0]
+            rows = self.db.execute(
+                'SELECT geometry, properties FROM features WHERE id IN '
+                '(SELECT feature_id FROM tile_features WHERE tile_id IN '
+                '({})) ORDER BY id'.format(_ids(found.values()))).fetchall()
+            self.db.execute(
+                'UPDATE tiles SET accessed = ? WHERE id IN ({})'.format(
+                    _ids(found.values())), (time.time(),))
+        return list(found), _load(rows)
+
+    def put(self, layer, where, fields, featuresets, key):
+        '''
+        Store featuresets given as a dict by tile id, keeping one copy of
+        each feature by the value of its key property, then evict the least
+        recently used tiles if the cache is over its size cap
+        '''
+        with self.lock, self.db:
+            for tile, featureset in featuresets.items():
+                self.db.execute(
+                    'INSERT INTO tiles (layer, where_clause, fields, tile, '
+                    'accessed) VALUES (?, ?, ?, ?, ?) ON CONFLICT (layer, '
+                    'where_clause, fields, tile) DO UPDATE SET '
+                    'accessed = excluded.accessed',
+                    (layer, where, fields, tile, time.time()))
+                tile_id = self.db.execute(
+                    'SELECT id FROM tiles WHERE layer = ? AND '
+                    'where_clause = ? AND fields = ? AND tile = ?',
+                    (layer, where, fields, tile)).fetchone()[0]
+                self.db.execute('DELETE FROM tile_features WHERE tile_id = ?',
+                                (tile_id,))
+
+                keys = (featureset.properties[key].tolist()
+                        if key in featureset.properties
+                        else [None] * len(featureset))
+                wkb = shapely.to_wkb(featureset.geometry)
+                for i, value in enumerate(keys):
+                    # features without a key can only be told apart within
+                    # their own tile
+                    if value is None or value is MISSING:
+                        value = '{}#{}'.format(tile, i)
+                    else:
+                        value = json.dumps(value)
+                    row = self.db.execute(
+                        'SELECT id FROM features WHERE layer = ? AND '
+                        'where_clause = ? AND fields = ? AND key = ?',
+                        (layer, where, fields, value)).fetchone()
+                    if row is None:
+                        properties = json.dumps(featureset.record(i))
+                        row = self.db.execute(
+                            'INSERT INTO features (layer, where_clause, '
+                            'fields, key, geometry, properties, size) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (layer, where, fields, value, wkb[i], properties,
+                             len(wkb[i] or b'') + len(properties)))
+                        row = (row.lastrowid,)
+                    self.db.execute(
+                        'INSERT OR IGNORE INTO tile_features VALUES (?, ?)',
+                        (tile_id, row[0]))
+            self._evict()
+
+    def _total(self):
+        return self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM features').fetchone()[0]
+
+    def _evict(self):
+        excess = self._total() - self.max_bytes
+        if excess <= 0:
+            return
+        for tile_id, in self.db.execute(
+                'SELECT id FROM tiles ORDER BY accessed').fetchall():
+            feature_ids = [row[0] for row in self.db.execute(
+                'SELECT feature_id FROM tile_features WHERE tile_id = ?',
+                (tile_id,))]
+            self.db.execute('DELETE FROM tile_features WHERE tile_id = ?',
+                            (tile_id,))
+            self.db.execute('DELETE FROM tiles WHERE id = ?', (tile_id,))
+
+            # features still held by another tile stay
+            orphans = ('id IN ({}) AND id NOT IN (SELECT feature_id FROM '
+                       'tile_features)'.format(_ids(feature_ids)))
+            excess -= self.db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM features WHERE ' +
+                orphans).fetchone()[0]
+            self.db.execute('DELETE FROM features WHERE ' + orphans)
+            if excess <= 0:
+                break
+
+    def _drop_layer(self, layer):
+        self.db.execute('DELETE FROM tile_features WHERE tile_id IN '
+                        '(SELECT id FROM tiles WHERE layer = ?)', (layer,))
+        self.db.execute('DELETE FROM tiles WHERE layer = ?', (layer,))
+        self.db.execute('DELETE FROM features WHERE layer = ?', (layer,))
+
+    def invalidate(self, layer):
+        '''
+        Drop every cached tile and feature of a layer, whatever its where
+        clause and fields
+        '''
+        with self.lock, self.db:
+            self._drop_layer(layer)
+
+    def layer_state(self, layer):
+        '''
+        Last seen upstream version of a layer and when it was last checked,
+        or (None, 0) for a layer that has never been checked
+        '''
+        with self.lock:
+            row = self.db.execute(
+                'SELECT version, checked FROM layers WHERE layer = ?',
+                (layer,)).fetchone()
+        return tuple(row) if row is not None else (None, 0)
+
+    def layers(self):
+        '''
+        (layer, provider, endpoint) of every layer that has been checked
+        '''
+        with self.lock:
+            return self.db.execute(
+                'SELECT layer, provider, endpoint FROM layers').fetchall()
+
+    def set_layer_version(self, layer, provider, endpoint, version):
+        '''
+        Record the upstream version of a layer, dropping its cached tiles
+        if the version is not the one last recorded. A version of None,
+        for a layer that reports no edit time, only records the check.
+        Returns True if the tiles were dropped
+        '''
+        with self.lock, self.db:
+            row = self.db.execute(
+                'SELECT version FROM layers WHERE layer = ?',
+                (layer,)).fetchone()
+            last = row[0] if row is not None else None
+            if version is None:
+                version = last
+            changed = version is not None and (row is None or
+                                               version != last)
+            if changed:
+                self._drop_layer(layer)
+            self.db.execute(
+                'INSERT OR REPLACE INTO layers VALUES (?, ?, ?, ?, ?)',
+                (layer, provider, endpoint, version, time.time()))
+        return changed
+
+    def size(self):
+        with self.lock:
+            return self._total()
+
+
+_tile_cache = None
+_tile_cache_pid = None
+
+
+def get_tile_cache():
+    '''
+    Tile cache for this worker process, or None if SETTINGS['tile_cache']
+    has no path
+    '''
+    global _tile_cache, _tile_cache_pid
+    settings = SETTINGS['tile_cache']
+    if not settings['path']:
+        return None
+    if (_tile_cache is None or _tile_cache_pid != os.getpid() or
+            _tile_cache.path != settings['path']):
+        _tile_cache = TileCache(settings['path'], settings['max_bytes'])
+        _tile_cache_pid = os.getpid()
+    return _tile_cache
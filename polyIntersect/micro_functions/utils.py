@@ -1,7 +1,7 @@
 from osgeo import ogr, osr
 import geojson as gj
-import urllib3
 import polyIntersect.micro_functions.urls as urls
+from polyIntersect.micro_functions.poly_intersect import get_session
 
 
 def verify_polygons(in_json):
@@ -161,7 +161,7 @@ def get_intersect_geom_from_endpoint(ogr_geom, layer, fields,
             'spatialReference': {'wkid': sr}}
 
     query = {'where': '1=1',
-             'geometry': geom,
+             'geometry': str(geom),
              'geometryType': 'esriGeometryEnvelope',
              'spatialRel': 'esriSpatialRelIntersects',
              'outFields': '*',
@@ -169,23 +169,22 @@ def get_intersect_geom_from_endpoint(ogr_geom, layer, fields,
              'outSR': '',
              'f': 'geojson'}
 
-    http = urllib3.PoolManager()
+    http = get_session()
 
     if layer == 'gadmAdm2':
-        intersect_polys = http.request('GET', urls.gadmAdm2, fields=query)
+        intersect_polys = http.get(urls.gadmAdm2, params=query)
 
     elif layer == 'gadmAdm1':
-        intersect_polys = http.request('GET', urls.gadmAdm1, fields=query)
+        intersect_polys = http.get(urls.gadmAdm1, params=query)
 
     elif layer == 'gadmAdm0':
-        intersect_polys = http.request('GET', urls.gadmAdm0, fields=query)
+        intersect_polys = http.get(urls.gadmAdm0, params=query)
 
     elif layer == 'TreePlantations':
-        intersect_polys = http.request('GET', urls.TreePlantations,
-                                       fields=query)
+        intersect_polys = http.get(urls.TreePlantations, params=query)
 
     else:
         raise AssertionError('Specified intersect_layer ({}) \
                               does not exist.'.format(layer))
 
-    return gj.dumps(gj.loads(intersect_polys.data.decode('utf-8')))
+    return gj.dumps(gj.loads(intersect_polys.content.decode('utf-8')))
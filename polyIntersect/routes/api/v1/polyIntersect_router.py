@@ -1,13 +1,22 @@
 from os import path
 import dask
 import json
-from flask import request, jsonify
-from polyIntersect.routes.api.v1 import endpoints
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import request, jsonify, Response
+from polyIntersect.config import SETTINGS
+from polyIntersect.routes.api.v1 import endpoints, error
 import polyIntersect.micro_functions.poly_intersect as analysis_funcs
-import requests
+from polyIntersect.serializers import encode_outputs, output_formats, JSON
+from polyIntersect.serializers import content_encodings, iter_compressed
 from datetime import datetime
 
 
+logger = logging.getLogger(__name__)
+
+
 def convert_date(date):
     return datetime.strptime(date, '%Y-%m-%d').strftime('%#m/%#d/%Y')
 
@@ -28,7 +37,7 @@ def create_dag_from_json(graphJson):
 
         # special_funcs = ['geojson', 'esri:server', 'gfw:pro']
         special_funcs = ['geojson', 'esri:server', 'esri:imageserver',
-                         'cartodb']
+                         'cartodb', 'mirror']
 
         func_name = v[0]
         is_valid = analysis_funcs.is_valid(func_name)
@@ -49,30 +58,184 @@ def create_dag_from_json(graphJson):
             graph[k] = tuple([analysis_funcs.esri_server2histo] + func_args)
         elif func_name == 'cartodb':
             graph[k] = tuple([analysis_funcs.cartodb2ogr] + func_args)
+        elif func_name == 'mirror':
+            graph[k] = tuple([analysis_funcs.mirror2ogr] + func_args)
         else:
             graph[k] = tuple([getattr(analysis_funcs, func_name)] + func_args)
 
     return graph
 
 
+def add_simplify_node(graph, outputs, policy):
+    '''
+    Route the node named in an analysis' simplify policy through a simplify
+    node, so everything downstream runs on simplified reference data, and
+    add the resulting area error bound to the outputs
+    '''
+    node = policy['node']
+    simplified = node + '-simplified'
+    for key, vals in graph.items():
+        graph[key] = [vals[0]] + [simplified if arg == node else arg
+                                  for arg in vals[1:]]
+    graph[simplified] = ['simplify', node, policy.get('extent', 'aoi'),
+                         policy['accuracy']]
+    graph['area-error'] = ['simplify_error', simplified]
+    return graph, outputs + ['area-error']
+
+
 def compute(graph, outputs):
     final_output = {}
     results = dask.get(graph, outputs)
     for result, name in zip(results, outputs):
-        if isinstance(result, dict) and 'features' in result.keys():
-            final_output[name] = analysis_funcs.ogr2json(result)
-        else:
-            final_output[name] = result
+        final_output[name] = result
     return final_output
 
 
+def is_true(value):
+    return (value or '').lower() in ('1', 'true', 'yes')
+
+
+def lookup_layer(dataset_id):
+    '''
+    Special function and layer url of a dataset, looked up in the gfw api
+    by the dataset's id
+    '''
+    host = 'https://production-api.globalforestwatch.org/v1'
+    dataset_endpoint = 'dataset/{}'.format(dataset_id)
+    dataset_url = path.join(host, dataset_endpoint)
+    response = None
+    try:
+        response = analysis_funcs.get_session().get(dataset_url)
+        dataset_info = response.json()
+        if 'errors' in dataset_info.keys():
+            raise ValueError(dataset_info['errors'])
+        layer_url = dataset_info['data']['attributes']['connectorUrl']
+        if '?' in layer_url:
+            layer_url = layer_url.split('?')[0]
+        provider = dataset_info['data']['attributes']['provider']
+        if provider == 'featureservice':
+            gfw_dataset = 'esri:server'
+        elif provider == 'cartodb':
+            gfw_dataset = 'cartodb'
+        else:
+            raise ValueError('GFW dataset endpoint not supported')
+
+        # REMOVE WHEN FIRES MOVED TO PROD
+        if 'Fires' in layer_url:
+            layer_url = layer_url.replace('gis-gfw', 'gfw-staging')
+    except Exception as e:
+        raise ValueError((str(e), response.text if response is not None
+                          else dataset_url))
+    return gfw_dataset, layer_url
+
+
+# dataset id -> (special function, layer url, time looked up)
+_layers = {}
+# dataset id -> thread refreshing its entry
+_refreshing = {}
+_layers_lock = threading.Lock()
+
+
+def refresh_layer(dataset_id):
+    '''
+    Look a dataset up in the gfw api and cache the result
+    '''
+    gfw_dataset, layer_url = lookup_layer(dataset_id)
+    with _layers_lock:
+        _layers[dataset_id] = (gfw_dataset, layer_url, time.time())
+    return gfw_dataset, layer_url
+
+
+def _refresh_in_background(dataset_id):
+    try:
+        refresh_layer(dataset_id)
+    except Exception as e:
+        logger.warning('refreshing gfw dataset %s failed: %s', dataset_id,
+                       e)
+    finally:
+        with _layers_lock:
+            _refreshing.pop(dataset_id, None)
+
+
+def resolve_layer(dataset_id):
+    '''
+    Special function and layer url of a dataset, cached per worker for
+    SETTINGS['gfw']['ttl'] seconds. Past that an entry is still served, for
+    up to SETTINGS['gfw']['max_stale'] seconds more, while a background
+    thread looks it up again
+    '''
+    settings = SETTINGS['gfw']
+    with _layers_lock:
+        entry = _layers.get(dataset_id)
+        age = time.time() - entry[2] if entry is not None else None
+        if age is not None and age < settings['ttl']:
+            return entry[:2]
+        stale = (age is not None and
+                 age < settings['ttl'] + settings['max_stale'])
+        if stale and dataset_id not in _refreshing:
+            _refreshing[dataset_id] = threading.Thread(
+                target=_refresh_in_background, args=(dataset_id,))
+            _refreshing[dataset_id].daemon = True
+            _refreshing[dataset_id].start()
+    if stale:
+        return entry[:2]
+    return refresh_layer(dataset_id)
+
+
+def warm_layers(datasets):
+    '''
+    Look up every dataset in a datasets.json dict, so the first request
+    for each does not wait on the gfw api. Lookups that fail are logged
+    and left to the first request
+    '''
+    dataset_ids = set(info['id'] for info in datasets.values()
+                      if info.get('id'))
+
+    def warm(dataset_id):
+        try:
+            refresh_layer(dataset_id)
+        except Exception as e:
+            logger.warning('looking up gfw dataset %s failed: %s',
+                           dataset_id, e)
+
+    with ThreadPoolExecutor(SETTINGS['gfw']['workers']) as executor:
+        list(executor.map(warm, dataset_ids))
+
+
+def mirror_path(dataset_info):
+    '''
+    Path of a dataset's GeoPackage mirror, or None if it is not mirrored
+    '''
+    if not dataset_info.get('mirror'):
+        return None
+    return path.join(SETTINGS['mirror']['path'], dataset_info['mirror'])
+
+
+def reads_features_only(graph):
+    '''
+    True if a graph only uses the dataset's layer url to read its features
+    '''
+    return all(vals[0] == '{gfw_dataset}' for vals in graph.values()
+               if '{layer_url}' in vals)
+
+
+def load_datasets():
+    with open(path.join(path.dirname(__file__), 'datasets.json')) as f:
+        return json.load(f)
+
+
 def execute_model(analysis, dataset, user_json, geojson2):
 
+    # decimal digits to round output coordinates to
+    precision = request.args.get('precision')
+    if precision is not None and not precision.isdigit():
+        return error(status=400, detail='precision must be a number of ' +
+                     'decimal digits')
+
     # read config files
     with open(path.join(path.dirname(__file__), 'analyses.json')) as f:
         analyses = json.load(f)
-    with open(path.join(path.dirname(__file__), 'datasets.json')) as f:
-        datasets = json.load(f)
+    datasets = load_datasets()
 
     # get dataset info
     category = datasets[dataset]['category'] if dataset else ''
@@ -80,35 +243,25 @@ def execute_model(analysis, dataset, user_json, geojson2):
     out_fields = ','.join([f for f in [category, field] if f])
     where = (datasets[dataset]['where'] if 'where' in datasets[dataset].keys()
              else '1=1')
+    dissolve = datasets[dataset].get('dissolve', '') if dataset else ''
+
+    # precision grid for reference data, set per dataset or per analysis
+    grid_size = ((datasets[dataset].get('grid_size', '') if dataset else '') or
+                 analyses[analysis].get('grid_size', ''))
 
-    # get gfw api url for dataset based on its id
+    # read reference data from a local mirror if one has been synced and
+    # the analysis only reads the layer's features, otherwise get its layer
+    # url from the gfw api
+    mirror = mirror_path(datasets[dataset]) if dataset else None
     dataset_id = datasets[dataset]['id'] if dataset else ''
+    if (mirror and path.exists(mirror) and
+            reads_features_only(analyses[analysis]['graph'])):
+        gfw_dataset, layer_url = 'mirror', mirror
+    elif dataset_id:
+        gfw_dataset, layer_url = resolve_layer(dataset_id)
 
-    # query gfw api for the layer url
-    if dataset_id:
-        try:
-            host = 'https://production-api.globalforestwatch.org/v1'
-            dataset_endpoint = 'dataset/{}'.format(dataset_id)
-            dataset_url = path.join(host, dataset_endpoint)
-            dataset_info = requests.get(dataset_url).json()
-            if 'errors' in dataset_info.keys():
-                raise ValueError(dataset_info['errors'])
-            layer_url = dataset_info['data']['attributes']['connectorUrl']
-            if '?' in layer_url:
-                layer_url = layer_url.split('?')[0]
-            provider = dataset_info['data']['attributes']['provider']
-            if provider == 'featureservice':
-                gfw_dataset = 'esri:server'
-            elif provider == 'cartodb':
-                gfw_dataset = 'cartodb'
-            else:
-                raise ValueError('GFW dataset endpoint not supported')
-
-            # REMOVE WHEN FIRES MOVED TO PROD
-            if 'Fires' in layer_url:
-                layer_url = layer_url.replace('gis-gfw', 'gfw-staging')
-        except Exception as e:
-            raise ValueError((str(e), requests.get(dataset_url).text))
+        # drop cached features of the layer if it was edited upstream
+        analysis_funcs.detect_changes(gfw_dataset, layer_url)
     else:
         layer_url = ''
         gfw_dataset = ''
@@ -123,16 +276,50 @@ def execute_model(analysis, dataset, user_json, geojson2):
                            layer_url=layer_url,
                            category=category,
                            field=field,
-                           where=where) for val in vals]
+                           where=where,
+                           dissolve=dissolve,
+                           grid_size=grid_size) for val in vals]
         graph[key] = vals
     outputs = analyses[analysis]['outputs']
 
+    # simplify reference data where the analysis allows for it
+    if 'simplify' in analyses[analysis]:
+        graph, outputs = add_simplify_node(graph, outputs,
+                                           analyses[analysis]['simplify'])
+
+    # a client can ask for just one of the outputs, so that a featureset
+    # output can be sent on its own in a binary geometry format
+    output = request.args.get('output')
+    if output is not None:
+        if output not in outputs:
+            return error(status=400, detail='output must be one of ' +
+                         ', '.join(outputs))
+        outputs = [output]
+
     # create and compute graph
     dag = create_dag_from_json(json.dumps(graph))
     data = compute(dag, outputs)
-    response = jsonify(data)
-    response.status_code = 200
-    return response
+
+    # a single featureset output can be sent in a binary geometry format
+    # the client asks for, anything else is sent as json
+    media_type = (request.accept_mimetypes.best_match(output_formats(data))
+                  if request.accept_mimetypes else None) or JSON
+
+    # featuresets are written as nested geojson while the response streams,
+    # or as geojson strings for clients that ask for the old format, unless
+    # a binary geometry format was picked
+    string_outputs = is_true(request.args.get('string_outputs'))
+    content_type, body = encode_outputs(data, media_type, string_outputs,
+                                        precision)
+
+    # compress while streaming if the client accepts it
+    headers = {'Vary': 'Accept-Encoding'}
+    encoding = request.accept_encodings.best_match(content_encodings())
+    if encoding:
+        body = iter_compressed(body, encoding)
+        headers['Content-Encoding'] = encoding
+    return Response(body, status=200, content_type=content_type,
+                    headers=headers)
 
 
 @endpoints.route('/ANALYSIS_KEY/hello',
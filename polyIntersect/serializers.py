@@ -1,5 +1,270 @@
 """Serializers"""
 
+import json
+import zlib
+from uuid import uuid4
+
+import numpy as np
+import shapely
+from shapely.geometry import mapping
+
+from polyIntersect.micro_functions.featureset import FeatureSet
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from osgeo import gdal, ogr, osr
+except ImportError:
+    ogr = None
+
+try:
+    import geobuf
+except ImportError:
+    geobuf = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# geometries converted to geojson text per call to GEOS
+GEOMETRY_BATCH = 1000
+
+JSON = 'application/json'
+WKB = 'application/wkb'
+FLATGEOBUF = 'application/flatgeobuf'
+GEOBUF = 'application/vnd.geobuf'
+
+# decimal digits kept by geobuf, which stores coordinates as integers
+GEOBUF_PRECISION = 9
+
+
+def _default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
+def dumps(obj):
+    """JSON text of a python value, using orjson when it is installed."""
+    if orjson is not None:
+        # area dicts may be keyed by numeric field values, which json
+        # writes as strings
+        return orjson.dumps(obj, default=_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY |
+                            orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(obj, default=_default)
+
+
+def round_coordinates(geometry, precision=None):
+    """Geometry array with coordinates rounded to precision decimal digits,
+    or the array itself if precision is None."""
+    if precision is None:
+        return geometry
+    precision = int(precision)
+    return shapely.transform(geometry,
+                             lambda coords: np.round(coords, precision))
+
+
+def iter_featureset_json(featureset, precision=None):
+    """Yield the GeoJSON text of a featureset in pieces, writing geometry
+    text straight from the geometry array in batches rather than building
+    a dict per feature. Coordinates are rounded to precision decimal digits
+    if it is given."""
+    yield '{"type": ' + dumps(featureset.type) + ', "features": ['
+
+    for start in range(0, len(featureset), GEOMETRY_BATCH):
+        stop = min(start + GEOMETRY_BATCH, len(featureset))
+        geometries = shapely.to_geojson(round_coordinates(
+            featureset.geometry[start:stop], precision))
+        records = [featureset.record(i) for i in range(start, stop)]
+        yield (', ' if start else '') + ', '.join(
+            '{"type": "Feature", "geometry": ' +
+            (geometry if geometry is not None else 'null') +
+            ', "properties": ' + dumps(record) + '}'
+            for geometry, record in zip(geometries, records))
+
+    yield ']'
+    if featureset.crs is not None:
+        yield ', "crs": ' + dumps(featureset.crs)
+    yield '}'
+
+
+def featureset_json(featureset, precision=None):
+    """GeoJSON text of a featureset."""
+    return ''.join(iter_featureset_json(featureset, precision))
+
+
+def iter_outputs_json(outputs, string_outputs=False, precision=None):
+    """Yield the JSON text of a dict of analysis outputs in pieces.
+    Featureset outputs are written as nested GeoJSON, or as GeoJSON strings
+    for clients that expect the older string outputs."""
+    yield '{'
+    for i, (name, value) in enumerate(outputs.items()):
+        yield (', ' if i else '') + dumps(name) + ': '
+        if isinstance(value, FeatureSet):
+            if string_outputs:
+                yield dumps(featureset_json(value, precision))
+            else:
+                for chunk in iter_featureset_json(value, precision):
+                    yield chunk
+        else:
+            yield dumps(value)
+    yield '}'
+
+
+def featureset_wkb(featureset, precision=None):
+    """WKB of a featureset's geometries as one GeometryCollection, in
+    feature order. Features without a geometry get an empty collection."""
+    geometry = round_coordinates(featureset.geometry, precision).copy()
+    geometry[shapely.is_missing(geometry)] = shapely.GeometryCollection()
+    return shapely.to_wkb(shapely.geometrycollections(geometry))
+
+
+def _ogr_field_type(column):
+    if column.dtype.kind == 'b':
+        return ogr.OFTInteger
+    if column.dtype.kind in 'iu':
+        return ogr.OFTInteger64
+    if column.dtype.kind == 'f':
+        return ogr.OFTReal
+    return ogr.OFTString
+
+
+def featureset_flatgeobuf(featureset, name, precision=None):
+    """FlatGeobuf file of a featureset, written by GDAL from WKB."""
+    path = '/vsimem/{}.fgb'.format(uuid4().hex)
+    source = ogr.GetDriverByName('FlatGeobuf').CreateDataSource(path)
+
+    srs = None
+    if featureset.crs is None or 'centroid' not in featureset.crs.get(
+            'properties', {}):
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    layer = source.CreateLayer(name, srs, ogr.wkbUnknown,
+                               options=['SPATIAL_INDEX=NO'])
+
+    columns = list(featureset.properties.items())
+    for column_name, column in columns:
+        layer.CreateField(ogr.FieldDefn(column_name, _ogr_field_type(column)))
+    definition = layer.GetLayerDefn()
+
+    geometry = round_coordinates(featureset.geometry, precision)
+    for i, wkb in enumerate(shapely.to_wkb(geometry)):
+        feature = ogr.Feature(definition)
+        if wkb is not None:
+            feature.SetGeometry(ogr.CreateGeometryFromWkb(wkb))
+        for column_name, value in featureset.record(i).items():
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = int(value)
+            elif not isinstance(value, (int, float, str)):
+                value = dumps(value)
+            feature.SetField(column_name, value)
+        layer.CreateFeature(feature)
+    layer = None
+    source = None
+
+    handle = gdal.VSIFOpenL(path, 'rb')
+    try:
+        return gdal.VSIFReadL(1, gdal.VSIStatL(path).size, handle)
+    finally:
+        gdal.VSIFCloseL(handle)
+        gdal.Unlink(path)
+
+
+def featureset_geobuf(featureset, precision=None):
+    """Geobuf encoding of a featureset."""
+    geometry = [mapping(geom) if geom is not None else None
+                for geom in featureset.geometry]
+    # geobuf.encode only takes positional arguments
+    return geobuf.encode(featureset.to_dict(geometry),
+                         GEOBUF_PRECISION if precision is None
+                         else int(precision))
+
+
+def single_featureset(outputs):
+    """The one output of a dict of analysis outputs if it is a featureset,
+    otherwise None."""
+    if len(outputs) != 1:
+        return None
+    value = next(iter(outputs.values()))
+    return value if isinstance(value, FeatureSet) else None
+
+
+def output_formats(outputs=None):
+    """Response media types that can be produced here, JSON first. Binary
+    geometry formats hold a single featureset, so for a dict of analysis
+    outputs they are only offered when it has just one featureset, and WKB,
+    which has no attributes, only when that featureset has no
+    properties."""
+    formats = [JSON]
+    featureset = None
+    if outputs is not None:
+        featureset = single_featureset(outputs)
+        if featureset is None:
+            return formats
+    if featureset is None or not featureset.properties:
+        formats.append(WKB)
+    if ogr is not None and ogr.GetDriverByName('FlatGeobuf') is not None:
+        formats.append(FLATGEOBUF)
+    if geobuf is not None:
+        formats.append(GEOBUF)
+    return formats
+
+
+def encode_outputs(outputs, media_type=JSON, string_outputs=False,
+                   precision=None):
+    """Content type and body iterator for analysis outputs in one of the
+    media types given by output_formats for them, with coordinates rounded
+    to precision decimal digits if it is given."""
+    if media_type == JSON:
+        return JSON, iter_outputs_json(outputs, string_outputs, precision)
+
+    if media_type not in output_formats(outputs):
+        raise ValueError('{} cannot hold these outputs'.format(media_type))
+    featureset = single_featureset(outputs)
+    name = next(iter(outputs))
+    if media_type == WKB:
+        body = featureset_wkb(featureset, precision)
+    elif media_type == FLATGEOBUF:
+        body = featureset_flatgeobuf(featureset, name, precision)
+    else:
+        body = featureset_geobuf(featureset, precision)
+    return media_type, iter([body])
+
+
+def content_encodings():
+    """Response content codings that can be produced here, best first."""
+    return (['br'] if brotli is not None else []) + ['gzip']
+
+
+def iter_compressed(body, encoding):
+    """Compress a body iterator chunk by chunk with gzip or brotli, so a
+    large response is never held whole in memory, encoded or not."""
+    if encoding == 'br':
+        compressor = brotli.Compressor()
+        compress, flush = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress, flush = compressor.compress, compressor.flush
+
+    for chunk in body:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compress(chunk)
+        if data:
+            yield data
+    yield flush()
+
 
 def serialize_greeting(greeting):
     """."""
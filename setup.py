@@ -8,6 +8,11 @@ setup(name='poly-intersect',
       description='geospatial web service',
       url='http://github.com/blueraster/poly-intersect',
       install_requires=install_requires,
+      extras_require={
+          'json': ['orjson>=3.6'],
+          'compression': ['brotli>=1.0'],
+          'formats': ['geobuf>=1.1', 'GDAL>=3.6'],
+      },
       packages=find_packages(),
       zip_safe=False,
       include_package_data=True)
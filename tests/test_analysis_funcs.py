@@ -1,22 +1,58 @@
 from os import path
 import sys
-import rtree
+import io
+import gzip
 import json
+import numpy as np
+import pytest
 
 from polyIntersect.micro_functions.poly_intersect import esri_server2ogr
 from polyIntersect.micro_functions.poly_intersect import cartodb2ogr
 from polyIntersect.micro_functions.poly_intersect import json2ogr
 from polyIntersect.micro_functions.poly_intersect import ogr2json
 from polyIntersect.micro_functions.poly_intersect import dissolve
+from polyIntersect.micro_functions.poly_intersect import query_intersecting
 from polyIntersect.micro_functions.poly_intersect import intersect
-from polyIntersect.micro_functions.poly_intersect import index_featureset
 from polyIntersect.micro_functions.poly_intersect import buffer_to_dist
 from polyIntersect.micro_functions.poly_intersect import project_local
 from polyIntersect.micro_functions.poly_intersect import project_global
 from polyIntersect.micro_functions.poly_intersect import get_area
 from polyIntersect.micro_functions.poly_intersect import get_area_percent
-
-
+from polyIntersect.micro_functions.poly_intersect import repair
+from polyIntersect.micro_functions.poly_intersect import erase
+from polyIntersect.micro_functions.poly_intersect import split
+from polyIntersect.micro_functions.poly_intersect import select
+from polyIntersect.micro_functions.poly_intersect import intersect_area
+from polyIntersect.micro_functions.poly_intersect import \
+    get_area_percent_from_area
+from polyIntersect.micro_functions.poly_intersect import get_geodesic_area
+from polyIntersect.micro_functions.poly_intersect import get_transformer
+from polyIntersect.micro_functions.poly_intersect import projection_frame
+from polyIntersect.micro_functions.poly_intersect import buffer_rings
+from polyIntersect.micro_functions.poly_intersect import spatial_partitions
+from polyIntersect.micro_functions.poly_intersect import clip
+from polyIntersect.micro_functions.poly_intersect import subdivide
+from polyIntersect.micro_functions.poly_intersect import simplify
+from polyIntersect.micro_functions.poly_intersect import simplify_error
+from polyIntersect.micro_functions.poly_intersect import get_session
+from polyIntersect.micro_functions.poly_intersect import detect_changes
+from polyIntersect.micro_functions.poly_intersect import refresh_layers
+from polyIntersect.micro_functions.poly_intersect import mirror2ogr
+from polyIntersect.micro_functions.mirror import write_geopackage
+from polyIntersect.micro_functions import poly_intersect
+from polyIntersect.micro_functions.tile_cache import get_tile_cache
+from polyIntersect.config import SETTINGS
+from polyIntersect.serializers import iter_outputs_json
+from polyIntersect.serializers import encode_outputs
+from polyIntersect.serializers import output_formats
+from polyIntersect.serializers import iter_compressed
+from polyIntersect import serializers
+from polyIntersect.micro_functions.featureset import FeatureSet
+from polyIntersect.micro_functions.geojson_reader import read_featureset
+
+
+import shapely
+from shapely.geometry import box
 from shapely.geometry.polygon import Polygon
 from shapely.geometry.multipolygon import MultiPolygon
 
@@ -27,14 +63,19 @@ from .sample_data import INTERSECT_MULTIPLE_FEATURES
 from .sample_data import INDONESIA_USER_POLY
 from .sample_data import BRAZIL_USER_POLY
 from .sample_data import AZE_TEST
+from .sample_data import SELF_INTERSECTING_GEOJSON
 
 fixtures = path.abspath(path.join(path.dirname(__file__), 'fixtures'))
 
 
-def test_successfully_index_featureset():
+def test_query_intersecting():
     featureset = json2ogr(DISSOLVE_GEOJSON)
-    index = index_featureset(featureset)
-    assert isinstance(index, rtree.index.Index)
+    idx, tree_idx = query_intersecting(featureset.geometry,
+                                       featureset.geometry)
+    assert len(idx) >= len(featureset)
+    assert (np.diff(idx) >= 0).all()
+    assert all(featureset.geometry[i].intersects(featureset.geometry[j])
+               for i, j in zip(idx, tree_idx))
 
 
 def test_successfully_dissolve_string_field():
@@ -69,6 +110,181 @@ def test_successfully_dissolve_no_field_arg():
     assert len(geom_diss['features']) == 1
 
 
+def test_partitioned_dissolve_matches_dissolve(monkeypatch):
+    monkeypatch.setitem(SETTINGS, 'dissolve',
+                        dict(workers=2, partition_size=20))
+    geoms = [box(i * 0.9, j * 0.9, i * 0.9 + 1, j * 0.9 + 1)
+             for i in range(15) for j in range(15)]
+    featureset = FeatureSet(geoms, {'value': [i % 2 for i in range(225)]})
+
+    partitions = spatial_partitions(featureset.geometry, 20)
+    assert len(partitions) > 1
+    assert sorted(np.concatenate(partitions)) == list(range(225))
+
+    for field in [None, 'value']:
+        expected = dissolve(featureset, field)
+        geom_diss = dissolve(featureset, field, 'partitioned')
+        assert len(geom_diss) == len(expected)
+        for geom, expected_geom in zip(geom_diss.geometry,
+                                       expected.geometry):
+            assert abs(geom.area - expected_geom.area) < 1e-9
+            assert geom.symmetric_difference(expected_geom).area < 1e-9
+
+
+def test_spatial_partitions_skip_missing_geometries():
+    geoms = np.array([box(i, 0, i + 1, 1) for i in range(10)] +
+                     [None, shapely.Polygon()], dtype=object)
+
+    partitions = spatial_partitions(geoms, 3)
+    assert sorted(np.concatenate(partitions)) == list(range(10))
+    for partition in partitions:
+        x = [geoms[i].centroid.x for i in partition]
+        assert max(x) - min(x) < 5
+
+
+def test_coverage_dissolve():
+    coverage = FeatureSet([box(i, j, i + 1, j + 1)
+                           for i in range(4) for j in range(4)],
+                          {'value': [i % 2 for i in range(16)]})
+    overlapping = FeatureSet([box(i * 0.9, 0, i * 0.9 + 1, 1)
+                              for i in range(4)])
+
+    for featureset, field in [(coverage, None), (coverage, 'value'),
+                              (overlapping, None)]:
+        expected = dissolve(featureset, field)
+        geom_diss = dissolve(featureset, field, 'coverage')
+        assert len(geom_diss) == len(expected)
+        for geom, expected_geom in zip(geom_diss.geometry,
+                                       expected.geometry):
+            assert geom.is_valid
+            assert geom.equals(expected_geom)
+
+
+def test_dissolve_clipped_to_extent():
+    featureset = json2ogr(INTERSECT_MULTIPLE_FEATURES)
+    extent = json2ogr(INTERSECT_PARTIALLY_WITHIN_GEOJSON)
+
+    geom_diss = dissolve(featureset, extent=extent)
+    xmin, ymin, xmax, ymax = shapely.total_bounds(extent.geometry)
+    assert geom_diss.geometry[0].within(box(xmin, ymin, xmax, ymax))
+    clipped = intersect(extent, geom_diss).geometry[0]
+    expected = intersect(extent, dissolve(featureset)).geometry[0]
+    assert clipped.symmetric_difference(expected).area < 1e-12
+
+
+def test_clip_before_dissolve():
+    featureset = json2ogr(INTERSECT_MULTIPLE_FEATURES)
+    aoi = json2ogr(INTERSECT_PARTIALLY_WITHIN_GEOJSON)
+
+    clipped = clip(featureset, aoi)
+    assert 0 < len(clipped) <= len(featureset)
+    assert all(aoi.geometry[0].buffer(1e-9).contains(g)
+               for g in clipped.geometry)
+    assert set(clipped.properties) == set(featureset.properties)
+
+    result = intersect(aoi, dissolve(clipped)).geometry[0]
+    expected = intersect(aoi, dissolve(featureset)).geometry[0]
+    assert result.symmetric_difference(expected).area < 1e-12
+
+
+def test_subdivided_overlay_matches():
+    aoi = json2ogr(INTERSECT_PARTIALLY_WITHIN_GEOJSON)
+    aoi = aoi.with_geometry(shapely.segmentize(aoi.geometry, 0.001))
+    featureset = json2ogr(INTERSECT_MULTIPLE_FEATURES)
+
+    pieces, parent = subdivide(aoi.geometry, 100)
+    assert len(pieces) > 1
+    assert shapely.get_num_coordinates(pieces).max() <= 100
+    assert abs(shapely.area(pieces).sum() - aoi.geometry[0].area) < 1e-12
+
+    for overlay in (intersect, erase):
+        expected = overlay(aoi, featureset)
+        result = overlay(aoi, featureset, max_vertices='100')
+        assert len(result) == len(expected)
+        assert shapely.area(shapely.symmetric_difference(
+            result.geometry, expected.geometry)).max() < 1e-12
+    aoi = project_local(aoi)
+    featureset = project_local(featureset, aoi.crs)
+    assert abs(intersect_area(aoi, featureset, max_vertices='100') -
+               intersect_area(aoi, featureset)) < 1e-6
+
+
+def test_intersect_area_overlapping_features():
+    aoi = FeatureSet([box(0, 0, 2, 2), box(1, 1, 3, 3)], {})
+    aoi.crs = project_local(json2ogr(DISSOLVE_GEOJSON)).crs
+    reference = FeatureSet([box(1, 0, 3, 2), box(1, 1, 3, 3)], {},
+                           crs=aoi.crs)
+
+    # overlapping parts of either side are only measured once
+    union = shapely.intersection(shapely.union_all(aoi.geometry),
+                                 shapely.union_all(reference.geometry))
+    assert abs(intersect_area(aoi, reference) -
+               union.area / 10000) < 1e-12
+    assert intersect_area(aoi, reference) <= get_area(dissolve(aoi))
+
+
+def test_grid_size_overlays():
+    featureset = json2ogr(SELF_INTERSECTING_GEOJSON, grid_size='0.001')
+    assert featureset.valid and featureset.grid_size == 0.001
+    assert shapely.is_valid(featureset.geometry).all()
+    coords = shapely.get_coordinates(featureset.geometry)
+    assert np.allclose(coords, np.round(coords / 0.001) * 0.001)
+
+    aoi = json2ogr(INTERSECT_PARTIALLY_WITHIN_GEOJSON)
+    reference = json2ogr(INTERSECT_MULTIPLE_FEATURES, grid_size='0.001')
+    for result in (intersect(aoi, reference), erase(aoi, reference),
+                   dissolve(reference), dissolve(reference, extent=aoi)):
+        assert result.grid_size == 0.001
+        coords = shapely.get_coordinates(result.geometry)
+        assert np.allclose(coords, np.round(coords / 0.001) * 0.001)
+
+    pieces = intersect(aoi, reference)
+    assert abs(intersect_area(aoi, reference, method='geodesic') -
+               get_geodesic_area(pieces)) < 1e-6
+    assert project_local(reference).grid_size is None
+
+
+def test_simplify_area_error_bound():
+    aoi = json2ogr(INTERSECT_PARTIALLY_WITHIN_GEOJSON)
+    featureset = json2ogr(INTERSECT_MULTIPLE_FEATURES)
+    featureset = featureset.with_geometry(
+        shapely.segmentize(featureset.geometry, 0.0001))
+
+    simplified = simplify(featureset, aoi, '0.001')
+    assert simplified.valid and shapely.is_valid(simplified.geometry).all()
+    assert (shapely.get_num_coordinates(simplified.geometry).sum() <
+            shapely.get_num_coordinates(featureset.geometry).sum())
+
+    error = simplify_error(simplified)
+    assert 0 < error <= 0.001
+    change = abs(intersect_area(aoi, simplified) -
+                 intersect_area(aoi, featureset))
+    assert change <= error * get_geodesic_area(aoi)
+
+
+def test_simplify_error_counts_segments():
+    # a unit square has four segments, one cap at the end of each
+    square = FeatureSet([box(0, 0, 1, 1)], {})
+    simplified = simplify(square, square, '0.001')
+    budget, perimeter, segments = 0.001, 4, 4
+    tolerance = budget / (perimeter + np.sqrt(
+        perimeter ** 2 + np.pi * segments * budget))
+    assert abs(simplify_error(simplified) -
+               (2 * tolerance * 4 + np.pi * tolerance ** 2 * 4)) < 1e-12
+
+
+def test_simplify_error_within_accuracy():
+    # many small features, where the caps outweigh the edges
+    aoi = FeatureSet([box(0, 0, 1, 1)], {})
+    for count, size in ((10, 0.01), (400, 0.001), (2000, 0.0001)):
+        x = np.arange(count) % 40 * 0.025
+        y = np.arange(count) // 40 * 0.02
+        squares = FeatureSet(shapely.segmentize(
+            shapely.box(x, y, x + size, y + size), size / 8), {})
+        simplified = simplify(squares, aoi, '0.001')
+        assert 0 < simplify_error(simplified) <= 0.001
+
+
 def test_maintain_crs():
     featureset = json2ogr(DISSOLVE_GEOJSON)
     assert len(featureset['features']) == 4
@@ -89,12 +305,83 @@ def test_successful_intersection():
                       MultiPolygon)
 
 
+def test_intersection_matches_pairwise_overlay():
+    featureset1 = json2ogr(INTERSECT_BASE_GEOJSON)
+    featureset2 = json2ogr(INTERSECT_MULTIPLE_FEATURES)
+
+    result_featureset = intersect(featureset1, featureset2)
+
+    expected = [geom1.intersection(geom2)
+                for geom1 in featureset1.geometry
+                for geom2 in featureset2.geometry
+                if geom1.intersects(geom2)]
+    assert len(result_featureset) == len(expected)
+    for geom, expected_geom in zip(result_featureset.geometry, expected):
+        assert geom.equals(expected_geom)
+
+
+def test_repair_self_intersecting():
+    featureset = json2ogr(SELF_INTERSECTING_GEOJSON, repair_geometry=False)
+    assert not featureset.valid
+    assert not all(geom.is_valid for geom in featureset.geometry)
+
+    repaired = repair(featureset)
+    assert repaired.valid
+    assert len(repaired) == len(featureset)
+    for geom in repaired.geometry:
+        assert geom.is_valid
+        assert isinstance(geom, (Polygon, MultiPolygon))
+
+    assert repair(repaired) is repaired
+    assert json2ogr(SELF_INTERSECTING_GEOJSON).valid
+
+
+def test_erase_one_feature_per_input():
+    featureset1 = json2ogr(INTERSECT_BASE_GEOJSON)
+    featureset2 = json2ogr(INTERSECT_MULTIPLE_FEATURES)
+
+    result_featureset = erase(featureset1, featureset2)
+    assert len(result_featureset) == len(featureset1)
+
+    covered = featureset2.geometry[0].union(featureset2.geometry[1])
+    expected = featureset1.geometry[0].difference(covered)
+    assert result_featureset.geometry[0].equals(expected)
+
+
+def test_erase_keeps_fully_erased_features():
+    featureset = json2ogr(INTERSECT_BASE_GEOJSON)
+
+    result_featureset = erase(featureset, featureset)
+    assert len(result_featureset) == len(featureset)
+    assert shapely.is_empty(result_featureset.geometry).all()
+    assert 'geometry' in json.loads(ogr2json(result_featureset))[
+        'features'][0]
+
+
+def test_split_matches_intersect_and_erase():
+    featureset1 = json2ogr(INTERSECT_BASE_GEOJSON)
+    featureset2 = json2ogr(INTERSECT_MULTIPLE_FEATURES)
+
+    split_featureset = split(featureset1, featureset2)
+    inside = select(split_featureset, 'split', 'inside')
+    outside = select(split_featureset, 'split', 'outside')
+    assert 'split' not in inside.properties
+
+    for result, expected in [(inside, intersect(featureset1, featureset2)),
+                             (outside, erase(featureset1, featureset2))]:
+        assert len(result) == len(expected)
+        for geom, expected_geom in zip(result.geometry, expected.geometry):
+            assert geom.equals(expected_geom)
+        assert ([f['properties'] for f in result['features']] ==
+                [f['properties'] for f in expected['features']])
+
+
 def test_project():
     featureset = json2ogr(DISSOLVE_GEOJSON)
     assert len(featureset['features']) == 4
 
     geom_projected = project_local(featureset)
-    assert isinstance(geom_projected, dict)
+    assert isinstance(geom_projected, FeatureSet)
     assert 'features' in geom_projected.keys()
     assert (geom_projected['crs']['properties']['name']
             == 'urn:ogc:def:uom:EPSG::9102')
@@ -106,6 +393,40 @@ def test_project():
             != 'urn:ogc:def:uom:EPSG::9102')
 
 
+def test_project_round_trip_reuses_transformers():
+    featureset = json2ogr(DISSOLVE_GEOJSON)
+
+    geom_projected = project_local(featureset)
+    hits = get_transformer.cache_info().hits
+    project_local(featureset)
+    assert get_transformer.cache_info().hits == hits + 1
+
+    geom_projected_back = project_global(geom_projected)
+    for geom_in, geom_out in zip(featureset.geometry,
+                                 geom_projected_back.geometry):
+        assert geom_in.equals_exact(geom_out, 1e-9)
+
+
+def test_project_into_shared_frame():
+    featureset1 = json2ogr(INTERSECT_BASE_GEOJSON)
+    featureset2 = json2ogr(INTERSECT_MULTIPLE_FEATURES)
+
+    frame = projection_frame(featureset1)
+    featureset1_projected = project_local(featureset1, frame)
+    featureset2_projected = project_local(featureset2, frame)
+    assert featureset1_projected.crs == featureset2_projected.crs
+
+    # overlays bring featuresets projected around other centres into the
+    # frame of their first argument
+    result_featureset = intersect(featureset1_projected,
+                                  project_local(featureset2))
+    expected = intersect(featureset1_projected, featureset2_projected)
+    assert result_featureset.crs == frame
+    for geom, expected_geom in zip(result_featureset.geometry,
+                                   expected.geometry):
+        assert geom.equals_exact(expected_geom, 1e-3)
+
+
 def test_project_already_projected():
     featureset = json2ogr(DISSOLVE_GEOJSON)
     assert len(featureset['features']) == 4
@@ -124,7 +445,7 @@ def test_projected_buffer():
 
     geom_projected = project_local(featureset)
     geom_buffered = buffer_to_dist(geom_projected, 10)
-    assert isinstance(geom_buffered, dict)
+    assert isinstance(geom_buffered, FeatureSet)
     assert 'features' in geom_buffered.keys()
     assert len(geom_buffered['features']) == 4
 
@@ -132,6 +453,22 @@ def test_projected_buffer():
         assert f_out['geometry'].area > f_in['geometry'].area
 
 
+def test_buffer_rings_match_single_buffers():
+    featureset = json2ogr(DISSOLVE_GEOJSON)
+    geom_projected = project_local(featureset)
+
+    rings = buffer_rings(geom_projected, '50,10', '16')
+    assert len(rings) == 2 * len(featureset)
+    for distance in ['10', '50']:
+        ring = select(rings, 'buffer_km', distance)
+        expected = buffer_to_dist(geom_projected, distance, '16')
+        assert len(ring) == len(expected)
+        assert list(ring.properties['id']) == list(expected.properties['id'])
+        assert shapely.equals_exact(ring.geometry, expected.geometry).all()
+        assert (shapely.get_num_coordinates(ring.geometry) ==
+                shapely.get_num_coordinates(expected.geometry)).all()
+
+
 def test_not_projected_buffer():
     featureset = json2ogr(DISSOLVE_GEOJSON)
     assert len(featureset['features']) == 4
@@ -189,10 +526,71 @@ def test_area_percent_with_categories():
             assert val > 0 and val <=100
 
 
+def test_intersect_area_without_pieces():
+    featureset1 = json2ogr(INTERSECT_BASE_GEOJSON)
+    featureset2 = json2ogr(INTERSECT_BASE_GEOJSON)
+    featureset2 = featureset2.with_geometry(shapely.transform(
+        featureset2.geometry, lambda coords: coords + 10))
+
+    assert intersect_area(featureset1, featureset2) == 0
+    assert intersect_area(featureset1, featureset2, int_field='id') == {}
+
+
+def test_intersect_area_matches_projected_intersection():
+    featureset1 = json2ogr(INTERSECT_BASE_GEOJSON)
+    featureset2 = json2ogr(INTERSECT_MULTIPLE_FEATURES)
+
+    result_projected = project_local(intersect(featureset1, featureset2))
+    expected = get_area(result_projected, 'value')
+
+    area = intersect_area(featureset1, featureset2, None, 'value')
+    assert set(area.keys()) == set(expected.keys())
+    for key, value in area.items():
+        assert abs(value - expected[key]) / expected[key] < 1e-3
+
+    total = intersect_area(featureset1, featureset2)
+    assert abs(total - sum(area.values())) < 1e-6
+
+
+def test_area_percent_from_area():
+    aoi_area = get_area(project_local(json2ogr(INTERSECT_BASE_GEOJSON)), 'id')
+    area = intersect_area(json2ogr(INTERSECT_BASE_GEOJSON),
+                          json2ogr(INTERSECT_MULTIPLE_FEATURES),
+                          'id', 'value')
+
+    area_pct = get_area_percent_from_area(area, aoi_area)
+    assert set(area_pct.keys()) == set(aoi_area.keys())
+    for area_pct_cats in area_pct.values():
+        assert len(area_pct_cats) == 2
+        for val in area_pct_cats.values():
+            assert val > 0 and val <= 100
+
+
+def test_geodesic_area_matches_projected_area():
+    for in_json in [DISSOLVE_GEOJSON, INTERSECT_MULTIPLE_FEATURES,
+                    BRAZIL_USER_POLY]:
+        featureset = json2ogr(in_json)
+        expected = get_area(project_local(featureset), 'id')
+        area = get_geodesic_area(featureset, 'id')
+        assert set(area.keys()) == set(expected.keys())
+        for key, value in area.items():
+            assert abs(value - expected[key]) / expected[key] < 1e-2
+
+
+def test_geodesic_area_one_degree_square():
+    featureset = json2ogr({'type': 'FeatureCollection', 'features': [{
+        'type': 'Feature', 'properties': {},
+        'geometry': {'type': 'Polygon',
+                     'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 1],
+                                      [0, 0]]]}}]})
+    # 12308.46 km2 between the equator and the 1st parallel on WGS84
+    assert abs(get_geodesic_area(featureset) - 1230846.39) < 1
+
+
 def test_json2ogr():
     geom_converted_version = json2ogr(DISSOLVE_GEOJSON)
 
-    assert isinstance(geom_converted_version, dict)
+    assert isinstance(geom_converted_version, FeatureSet)
     assert 'features' in geom_converted_version.keys()
 
     for f in geom_converted_version['features']:
@@ -208,6 +606,358 @@ def test_ogr2json():
         assert isinstance(f['geometry'], dict)
 
 
+def test_outputs_json():
+    featureset = json2ogr(DISSOLVE_GEOJSON)
+    outputs = {'geom': featureset, 'area': 1.5}
+
+    nested = json.loads(''.join(iter_outputs_json(outputs)))
+    assert nested['area'] == 1.5
+    assert nested['geom'] == json.loads(ogr2json(featureset))
+    assert len(nested['geom']['features']) == len(featureset)
+
+    strings = json.loads(''.join(iter_outputs_json(outputs, True)))
+    assert json.loads(strings['geom']) == nested['geom']
+
+
+@pytest.mark.parametrize('backend', ['json', 'orjson'])
+def test_outputs_json_backends(monkeypatch, backend):
+    if backend == 'json':
+        monkeypatch.setattr(serializers, 'orjson', None)
+    else:
+        pytest.importorskip('orjson')
+    featureset = json2ogr(DISSOLVE_GEOJSON)
+    outputs = {'geom': featureset, 'count': np.int64(4),
+               'areas': {'A': np.float64(1.5)},
+               'by-id': {1: {2: 0.5}, 3: {4: 0.25}}}
+
+    nested = json.loads(''.join(iter_outputs_json(outputs)))
+    assert nested['count'] == 4 and nested['areas'] == {'A': 1.5}
+    assert nested['by-id'] == {'1': {'2': 0.5}, '3': {'4': 0.25}}
+    assert nested['geom']['features'][0]['properties'] == featureset.record(0)
+
+
+def test_outputs_wkb():
+    featureset = json2ogr(DISSOLVE_GEOJSON)
+    assert output_formats({'geom': featureset, 'area': 1.5}) == [
+        'application/json']
+    # wkb would lose the properties that tell the features apart
+    assert 'application/wkb' not in output_formats({'geom': featureset})
+    with pytest.raises(ValueError):
+        encode_outputs({'geom': featureset}, 'application/wkb')
+
+    dissolved = dissolve(featureset, field=None)
+    split = FeatureSet(shapely.get_parts(dissolved.geometry), {})
+    assert 'application/wkb' in output_formats({'geom': split})
+    content_type, body = encode_outputs({'geom': split}, 'application/wkb')
+    assert content_type == 'application/wkb'
+    collection = shapely.from_wkb(b''.join(body))
+    assert len(collection.geoms) == len(split)
+    assert collection.geoms[0].equals(split.geometry[0])
+
+
+def test_outputs_geobuf():
+    geobuf = pytest.importorskip('geobuf')
+    featureset = json2ogr(DISSOLVE_GEOJSON)
+    content_type, body = encode_outputs({'geom': featureset},
+                                        'application/vnd.geobuf')
+    assert content_type == 'application/vnd.geobuf'
+
+    decoded = geobuf.decode(b''.join(body))
+    assert len(decoded['features']) == len(featureset)
+    for feature, geom in zip(decoded['features'], featureset.geometry):
+        assert shapely.equals_exact(
+            shapely.geometry.shape(feature['geometry']), geom, 1e-9)
+    assert decoded['features'][0]['properties'] == featureset.record(0)
+
+
+def test_outputs_flatgeobuf(tmp_path):
+    ogr = pytest.importorskip('osgeo.ogr')
+    if ogr.GetDriverByName('FlatGeobuf') is None:
+        pytest.skip('GDAL has no FlatGeobuf driver')
+    featureset = json2ogr(DISSOLVE_GEOJSON)
+    content_type, body = encode_outputs({'geom': featureset},
+                                        'application/flatgeobuf')
+    assert content_type == 'application/flatgeobuf'
+
+    path = tmp_path / 'geom.fgb'
+    path.write_bytes(b''.join(body))
+    layer = ogr.Open(str(path)).GetLayer()
+    assert layer.GetFeatureCount() == len(featureset)
+    feature = layer.GetNextFeature()
+    assert shapely.from_wkb(bytes(
+        feature.GetGeometryRef().ExportToWkb())).equals(
+            featureset.geometry[0])
+    assert feature.GetField('str_value') == featureset.record(0)['str_value']
+
+
+def test_outputs_precision_and_gzip():
+    featureset = json2ogr(INTERSECT_MULTIPLE_FEATURES)
+    content_type, body = encode_outputs({'geom': featureset}, precision='3')
+    data = gzip.decompress(b''.join(iter_compressed(body, 'gzip')))
+
+    geom = json.loads(data)['geom']
+    coords = shapely.get_coordinates(shapely.from_geojson(json.dumps(
+        geom['features'][0]['geometry'])))
+    assert np.array_equal(coords, np.round(coords, 3))
+    assert np.abs(coords - shapely.get_coordinates(
+        featureset.geometry[0])).max() <= 0.0005
+
+
+def test_outputs_brotli():
+    brotli = pytest.importorskip('brotli')
+    featureset = json2ogr(INTERSECT_MULTIPLE_FEATURES)
+    content_type, body = encode_outputs({'geom': featureset})
+    body = b''.join(chunk.encode('utf-8') for chunk in body)
+
+    content_type, chunks = encode_outputs({'geom': featureset})
+    assert brotli.decompress(b''.join(iter_compressed(chunks, 'br'))) == body
+
+
+def test_featureset_dict_round_trip():
+    in_json = json.loads(DISSOLVE_GEOJSON)
+    featureset = json2ogr(DISSOLVE_GEOJSON)
+    assert featureset.properties['str_value'].dtype.kind == 'U'
+    assert featureset.properties['int_value'].dtype.kind == 'i'
+
+    out_json = json.loads(ogr2json(featureset))
+    assert out_json['crs'] == in_json['crs']
+    for i, (f_in, f_out) in enumerate(zip(in_json['features'],
+                                          out_json['features'])):
+        assert f_out['properties'] == dict(f_in['properties'], id=i)
+
+    featureset_back = FeatureSet.from_dict(featureset.to_dict())
+    assert len(featureset_back) == len(featureset)
+    for geom_in, geom_out in zip(featureset.geometry,
+                                 featureset_back.geometry):
+        assert geom_in.equals(geom_out)
+
+
+def test_json2ogr_streaming():
+    expected = json2ogr(json.loads(INTERSECT_MULTIPLE_FEATURES))
+    for source in (INTERSECT_MULTIPLE_FEATURES,
+                   INTERSECT_MULTIPLE_FEATURES.encode('utf-8'),
+                   io.BytesIO(INTERSECT_MULTIPLE_FEATURES.encode('utf-8'))):
+        featureset = json2ogr(source)
+        assert len(featureset) == len(expected)
+        for i in range(len(featureset)):
+            assert featureset.record(i) == expected.record(i)
+            assert featureset.geometry[i].equals(expected.geometry[i])
+
+    # features split across many small reads
+    source = io.BytesIO(DISSOLVE_GEOJSON.encode('utf-8'))
+    featureset = read_featureset(source, batch_size=3, chunk_size=16)
+    assert len(featureset) == len(json.loads(DISSOLVE_GEOJSON)['features'])
+
+
+def test_shared_session():
+    session = get_session()
+    assert session is get_session()
+
+    adapter = session.get_adapter('https://wri-01.carto.com/api/v2/sql')
+    assert adapter.timeout == (SETTINGS['http']['connect_timeout'],
+                               SETTINGS['http']['read_timeout'])
+    assert adapter is session.get_adapter('http://gis-gfw.wri.org')
+
+
+class FakeEsriResponse(object):
+    def __init__(self, body):
+        self.body = json.dumps(body)
+        self.raw = io.BytesIO(self.body.encode('utf-8'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class FakeEsriSession(object):
+    '''
+    Layer with a record limit of two, where the second aoi feature's bbox
+    overlaps the first one's results
+    '''
+    results = {0: [1, 2, 3, 4, 5], 1: [4, 5, 6]}
+
+    def post(self, url, data, stream=False):
+        xmin = eval(data['geometry'])['rings'][0][0][0]
+        objectids = self.results[0 if xmin < 0.5 else 1]
+        if data.get('returnCountOnly'):
+            return FakeEsriResponse({'count': len(objectids)})
+        offset = data.get('resultOffset', 0)
+        page = objectids[offset:offset + 2]
+        return FakeEsriResponse({
+            'type': 'FeatureCollection',
+            'exceededTransferLimit': offset + 2 < len(objectids),
+            'features': [{
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [i, i]},
+                'properties': {'objectid': i}} for i in page]})
+
+
+def test_esri_server2ogr_pages(monkeypatch):
+    monkeypatch.setattr(poly_intersect, 'get_session', FakeEsriSession)
+    monkeypatch.setitem(SETTINGS['tile_cache'], 'path', '')
+    aoi = json.dumps({'type': 'FeatureCollection', 'features': [{
+        'type': 'Feature', 'properties': {},
+        'geometry': {'type': 'Point', 'coordinates': [x, x]}}
+        for x in (0, 1)]})
+
+    featureset = esri_server2ogr('http://fake/MapServer/0', aoi, '')
+    assert featureset.properties['objectid'].tolist() == [1, 2, 3, 4, 5, 6]
+    assert featureset.properties['id'].tolist() == list(range(6))
+
+
+def test_esri_tile_cache(monkeypatch, tmp_path):
+    queries = []
+
+    class CountingSession(FakeEsriSession):
+        def post(self, url, data, stream=False):
+            queries.append(eval(data['geometry'])['rings'][0][0])
+            return FakeEsriSession.post(self, url, data, stream)
+
+    monkeypatch.setattr(poly_intersect, 'get_session', CountingSession)
+    monkeypatch.setitem(SETTINGS['tile_cache'], 'path',
+                        str(tmp_path / 'tiles.sqlite'))
+    monkeypatch.setitem(SETTINGS['tile_cache'], 'zoom', 8)
+
+    def aoi(*coords):
+        return json.dumps({'type': 'FeatureCollection', 'features': [{
+            'type': 'Feature', 'properties': {},
+            'geometry': {'type': 'Point', 'coordinates': [x, x]}}
+            for x in coords]})
+
+    layer = 'http://fake/MapServer/1'
+    featureset = esri_server2ogr(layer, aoi(0.1), '')
+    assert featureset.properties['objectid'].tolist() == [1, 2, 3, 4, 5]
+    assert set(map(tuple, queries)) == {(0, 0)}
+
+    # only the tile the cache does not hold yet is queried
+    del queries[:]
+    featureset = esri_server2ogr(layer, aoi(0.2, 2), '')
+    assert featureset.properties['objectid'].tolist() == [1, 2, 3, 4, 5, 6]
+    assert set(map(tuple, queries)) == {(1.40625, 1.40625)}
+
+    # features in both tiles are stored once
+    cache = get_tile_cache()
+    tiles, cached = cache.get(layer + '/query', '1=1', 'objectid',
+                              ['8/128/64', '8/129/65'])
+    assert tiles == ['8/128/64', '8/129/65']
+    assert cached.properties['objectid'].tolist() == [1, 2, 3, 4, 5, 6]
+
+    # least recently used tiles go first once the cache is too large, and
+    # only the features no other tile holds go with them
+    cache.get(layer + '/query', '1=1', 'objectid', ['8/128/64'])
+    cache.max_bytes = cache.size() - 1
+    cache.put(layer + '/query', '1=1', 'objectid', {}, 'objectid')
+    tiles, cached = cache.get(layer + '/query', '1=1', 'objectid',
+                              ['8/128/64', '8/129/65'])
+    assert tiles == ['8/128/64']
+    assert cached.properties['objectid'].tolist() == [1, 2, 3, 4, 5]
+
+
+class FakeCartoSession(object):
+    def get(self, url, params=None, stream=False):
+        return FakeEsriResponse({'type': 'FeatureCollection',
+                                 'features': []})
+
+
+def test_cartodb_tile_cache_empty(monkeypatch, tmp_path):
+    monkeypatch.setattr(poly_intersect, 'get_session', FakeCartoSession)
+    monkeypatch.setitem(SETTINGS['tile_cache'], 'path',
+                        str(tmp_path / 'tiles.sqlite'))
+
+    endpoint = 'https://fake.carto.com/tables/sites'
+    for _ in range(2):
+        featureset = cartodb2ogr(endpoint, DISSOLVE_GEOJSON, 'species')
+        assert len(featureset) == 0
+        assert 'cartodb_id' not in featureset.properties
+
+
+class FakeLayerSession(object):
+    last_edit = 1
+
+    def get(self, url, params=None):
+        return FakeEsriResponse({'editingInfo': {
+            'lastEditDate': FakeLayerSession.last_edit}})
+
+
+def test_detect_changes(monkeypatch, tmp_path):
+    monkeypatch.setattr(poly_intersect, 'get_session', FakeLayerSession)
+    monkeypatch.setitem(SETTINGS['tile_cache'], 'path',
+                        str(tmp_path / 'tiles.sqlite'))
+    layer = 'http://fake/MapServer/2'
+    cache = get_tile_cache()
+    tile = {'8/128/64': json2ogr(DISSOLVE_GEOJSON, repair_geometry=False)}
+
+    def cached(where='1=1'):
+        return bool(cache.get(layer + '/query', where, 'objectid',
+                              ['8/128/64'])[0])
+
+    detect_changes('esri:server', layer)
+    cache.put(layer + '/query', '1=1', 'objectid', tile, 'id')
+    cache.put(layer + '/query', '1=0', 'objectid', tile, 'id')
+
+    # unchanged layers are only polled once per interval
+    FakeLayerSession.last_edit = 2
+    assert not detect_changes('esri:server', layer)
+    assert cached()
+
+    assert detect_changes('esri:server', layer, force=True)
+    assert not cached()
+    assert not cached('1=0')
+    assert cache.size() == 0
+
+    cache.put(layer + '/query', '1=1', 'objectid', tile, 'id')
+    assert refresh_layers() == {layer: False}
+    assert cached()
+
+    # failed polls are reported, and the cached tiles kept
+    monkeypatch.setattr(FakeLayerSession, 'get', None)
+    assert isinstance(refresh_layers()[layer], TypeError)
+    assert not detect_changes('esri:server', layer, force=True)
+    assert cached()
+
+
+def test_mirror2ogr(tmp_path):
+    featureset = json2ogr(DISSOLVE_GEOJSON, repair_geometry=False)
+    mirror = str(tmp_path / 'dissolve.gpkg')
+    write_geopackage(mirror, 'dissolve', featureset)
+
+    mirrored = mirror2ogr(mirror, DISSOLVE_GEOJSON, 'str_value,int_value')
+    assert list(mirrored.properties) == ['str_value', 'int_value', 'id']
+    assert mirrored.properties['str_value'].tolist() == ['A', 'A', 'B', 'B']
+    assert all(a.equals(b) for a, b in zip(mirrored.geometry,
+                                           featureset.geometry))
+
+    # only features near the aoi are read, and where clauses apply
+    aoi = ogr2json(featureset.take([0]))
+    mirrored = mirror2ogr(mirror, aoi, 'int_value', "str_value = 'B'")
+    assert len(mirrored) < len(featureset)
+    assert set(mirrored.properties['int_value'].tolist()) <= {2}
+
+
+def test_mirror2ogr_resync_and_json(tmp_path):
+    featureset = json2ogr(DISSOLVE_GEOJSON, repair_geometry=False)
+    mirror = str(tmp_path / 'dissolve.gpkg')
+    write_geopackage(mirror, 'dissolve', featureset)
+    mirrored = mirror2ogr(mirror, DISSOLVE_GEOJSON, 'tags')
+    assert 'tags' not in mirrored.properties
+
+    # a mirror replaced by another process is read without clearing caches
+    featureset.properties['tags'] = np.array(
+        [['a'], {'b': 1}, '[1]', None], dtype=object)
+    write_geopackage(mirror, 'dissolve', featureset.take([0, 1, 2, 3]))
+    mirrored = mirror2ogr(mirror, DISSOLVE_GEOJSON, 'tags')
+    assert mirrored.properties['tags'].tolist() == [['a'], {'b': 1}, '[1]',
+                                                    None]
+
+
 def test_esri_server2json():
     host = 'http://gis-gfw.wri.org'
     layer = 'forest_cover/MapServer/0'
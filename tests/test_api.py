@@ -1,17 +1,234 @@
 import json
+import threading
 
+import numpy as np
 import pytest
+import shapely
 
+import polyIntersect
 from polyIntersect import app
+from polyIntersect.config import SETTINGS
+from polyIntersect.micro_functions.featureset import FeatureSet
+from polyIntersect.micro_functions.poly_intersect import json2ogr
+from polyIntersect.micro_functions.mirror import write_geopackage
+from polyIntersect.micro_functions import poly_intersect
+from polyIntersect.routes.api.v1 import polyIntersect_router
+from polyIntersect.routes.api.v1.polyIntersect_router import execute_model
+from polyIntersect.routes.api.v1.polyIntersect_router import resolve_layer
 
 # data
 from .sample_data import BRAZIL_USER_POLY
 from .sample_data import INDONESIA_USER_POLY
+from .sample_data import INTERSECT_BASE_GEOJSON
+from .sample_data import INTERSECT_PARTIALLY_WITHIN_GEOJSON
 
 
 # test flask client
+flask_app = app
 app = app.test_client()
 
+
+def test_accept_falls_back_to_json(monkeypatch, tmp_path):
+    monkeypatch.setitem(SETTINGS['mirror'], 'path', str(tmp_path))
+    write_geopackage(str(tmp_path / 'wdpa.gpkg'), 'wdpa',
+                     json2ogr(INTERSECT_BASE_GEOJSON))
+
+    # other outputs, and formats that cannot be produced, get json
+    for analysis, accept in (('area', 'application/wkb'),
+                             ('area-and-geom', 'application/wkb'),
+                             ('geom', 'application/wkb'),
+                             ('geom', 'text/plain')):
+        headers = {'Accept': accept}
+        with flask_app.test_request_context(headers=headers):
+            response = execute_model(analysis, 'wdpa',
+                                     INTERSECT_PARTIALLY_WITHIN_GEOJSON, '')
+        assert response.status_code == 200
+        assert response.content_type == 'application/json'
+        assert json.loads(response.get_data())
+
+
+def test_output_selector(monkeypatch, tmp_path):
+    monkeypatch.setitem(SETTINGS['mirror'], 'path', str(tmp_path))
+    write_geopackage(str(tmp_path / 'wdpa.gpkg'), 'wdpa',
+                     json2ogr(INTERSECT_BASE_GEOJSON))
+
+    def run(analysis, output, accept='application/json'):
+        with flask_app.test_request_context(
+                query_string={'output': output}, headers={'Accept': accept}):
+            return execute_model(analysis, 'wdpa',
+                                 INTERSECT_PARTIALLY_WITHIN_GEOJSON, '')
+
+    # one output of a multi-output analysis, as json
+    response = run('area-and-geom', 'intersect-area')
+    assert list(json.loads(response.get_data())) == ['intersect-area']
+
+    # a featureset without properties can be sent as wkb
+    response = run('dissolve', 'dissolved-geom', 'application/wkb')
+    assert response.content_type == 'application/wkb'
+    assert not shapely.from_wkb(response.get_data()).is_empty
+
+    # featuresets with properties need a format that keeps them
+    response = run('erase-and-intersect-geom', 'intersect-geom',
+                   'application/wkb, application/json;q=0.5')
+    assert response.content_type == 'application/json'
+    geobuf = pytest.importorskip('geobuf')
+    response = run('erase-and-intersect-geom', 'intersect-geom',
+                   'application/vnd.geobuf')
+    assert response.content_type == 'application/vnd.geobuf'
+    features = geobuf.decode(response.get_data())['features']
+    assert features and features[0]['properties']
+
+    response, status = run('area-and-geom', 'missing')
+    assert status == 400
+
+
+def test_mirrored_dataset(monkeypatch, tmp_path):
+    monkeypatch.setitem(SETTINGS['mirror'], 'path', str(tmp_path))
+    write_geopackage(str(tmp_path / 'wdpa.gpkg'), 'wdpa',
+                     json2ogr(INTERSECT_BASE_GEOJSON))
+
+    # runs offline: the dataset is neither looked up nor fetched
+    with flask_app.test_request_context():
+        response = execute_model('area', 'wdpa',
+                                 INTERSECT_PARTIALLY_WITHIN_GEOJSON, '')
+    assert response.status_code == 200
+    result = json.loads(response.get_data())
+    assert 0 < result['intersect-area'] < result['aoi-area']
+
+
+def test_buffered_areas_under_full_cover(monkeypatch, tmp_path):
+    monkeypatch.setitem(SETTINGS['mirror'], 'path', str(tmp_path))
+    aoi = json2ogr(INDONESIA_USER_POLY)
+    xmin, ymin, xmax, ymax = shapely.total_bounds(aoi.geometry)
+    x, y = np.meshgrid(np.arange(xmin - 2, xmax + 2, 0.2),
+                       np.arange(ymin - 2, ymax + 2, 0.2))
+    cells = shapely.box(x.ravel(), y.ravel(), x.ravel() + 0.2, y.ravel() + 0.2)
+    write_geopackage(str(tmp_path / 'wdpa.gpkg'), 'wdpa',
+                     FeatureSet(cells, {}))
+
+    # reference data covering every buffer covers all of its area, however
+    # its edges cross the buffers
+    with flask_app.test_request_context():
+        response = execute_model('area-and-geom-buffered', 'wdpa',
+                                 INDONESIA_USER_POLY, '')
+    assert response.status_code == 200
+    result = json.loads(response.get_data())
+    assert result['intersect-area'] == pytest.approx(result['aoi-area'])
+    for buffer in ('buffer-10km', 'buffer-50km'):
+        assert result[buffer + '-intersect-area'] == pytest.approx(
+            result[buffer + '-area'], rel=1e-9)
+
+
+class FakeGFWResponse(object):
+    def __init__(self, body):
+        self.text = json.dumps(body)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeGFWSession(object):
+    requests = []
+    connector = 'https://example.com/arcgis/rest/services/layer/MapServer/0'
+
+    def get(self, url):
+        FakeGFWSession.requests.append(url)
+        if url.endswith('missing'):
+            return FakeGFWResponse({'errors': [{'status': 404}]})
+        return FakeGFWResponse({'data': {'attributes': {
+            'connectorUrl': FakeGFWSession.connector + '?f=pjson',
+            'provider': 'featureservice'}}})
+
+
+def test_resolve_layer_cache(monkeypatch):
+    monkeypatch.setattr(poly_intersect, 'get_session', FakeGFWSession)
+    monkeypatch.setattr(polyIntersect_router, '_layers', {})
+    del FakeGFWSession.requests[:]
+
+    layer = ('esri:server', FakeGFWSession.connector)
+    assert resolve_layer('dataset') == layer
+    assert resolve_layer('dataset') == layer
+    assert len(FakeGFWSession.requests) == 1
+
+    # a stale entry is served while it is looked up again
+    polyIntersect_router._layers['dataset'] = (
+        'esri:server', 'stale', 0)
+    monkeypatch.setitem(SETTINGS['gfw'], 'max_stale', float('inf'))
+    assert resolve_layer('dataset') == ('esri:server', 'stale')
+    for thread in list(polyIntersect_router._refreshing.values()):
+        thread.join()
+    assert resolve_layer('dataset') == layer
+    assert len(FakeGFWSession.requests) == 2
+
+    # errors are reported from the one failed lookup
+    with pytest.raises(ValueError):
+        resolve_layer('missing')
+    assert len(FakeGFWSession.requests) == 3
+
+
+def _registration_timers():
+    return any(isinstance(thread, threading.Timer)
+               for thread in threading.enumerate())
+
+
+def test_pool_processes_do_not_register(monkeypatch):
+    monkeypatch.setenv('CT_REGISTER_MODE', 'auto')
+    monkeypatch.setenv('CT_URL', 'http://127.0.0.1:9')
+    monkeypatch.setattr(poly_intersect, '_pool', None)
+    monkeypatch.setattr(poly_intersect, '_pool_pid', None)
+
+    # the pool processes import the app, but must not register it with
+    # control tower, which exits them when it is unreachable
+    pool = poly_intersect.get_pool()
+    try:
+        assert not pool.submit(_registration_timers).result()
+    finally:
+        pool.shutdown()
+
+
+def test_refresh_layers_command(monkeypatch):
+    runner = flask_app.test_cli_runner()
+    monkeypatch.setattr(polyIntersect, 'refresh_layers', lambda: {
+        'layer/1': True, 'layer/2': False})
+    result = runner.invoke(args=['refresh-layers'])
+    assert result.exit_code == 0
+    assert result.output == 'layer/1: changed\nlayer/2: unchanged\n'
+
+    monkeypatch.setattr(polyIntersect, 'refresh_layers', lambda: {
+        'layer/1': ValueError('timed out'), 'layer/2': False})
+    result = runner.invoke(args=['refresh-layers'])
+    assert result.exit_code == 1
+    assert 'layer/1: failed, timed out' in result.output
+
+
+def test_sync_mirrors_command(monkeypatch, tmp_path):
+    monkeypatch.setitem(SETTINGS['mirror'], 'path', str(tmp_path))
+    monkeypatch.setattr(polyIntersect, 'load_datasets', lambda: {
+        'a': {'id': 'a', 'mirror': 'a.gpkg'},
+        'b': {'id': 'b', 'mirror': 'b.gpkg'},
+        'c': {'id': 'c'}})
+    monkeypatch.setattr(polyIntersect, 'resolve_layer',
+                        lambda dataset_id: ('esri:server', dataset_id))
+
+    def sync_mirror(provider, layer_url, mirror):
+        if layer_url == 'a':
+            raise ValueError('timed out')
+        return 3
+    monkeypatch.setattr(polyIntersect, 'sync_mirror', sync_mirror)
+    runner = flask_app.test_cli_runner()
+
+    # the other layers still sync after one fails
+    result = runner.invoke(args=['sync-mirrors'])
+    assert result.exit_code == 1
+    assert 'a: failed, timed out' in result.output
+    assert 'b: 3 features to {}'.format(tmp_path / 'b.gpkg') in result.output
+
+    result = runner.invoke(args=['sync-mirrors', 'b'])
+    assert result.exit_code == 0
+    result = runner.invoke(args=['sync-mirrors', 'c'])
+    assert result.exit_code == 2
+
+
 # slow = pytest.mark.skipif(
 #     not pytest.config.getoption("--runslow"),
 #     reason="need --runslow option to run"